@@ -26,6 +26,7 @@ __all__ = [
           , "CreateTag"
           , "DeleteTag"
           , "CollectGarbage"
+          , "FetchShard"
           , "PatchFileAction"
               , "ApplyPatchFile"
               , "HEAD2PatchFile"
@@ -37,6 +38,7 @@ __all__ = [
   , "LOG_STANDARD"
   , "switch_context"
   , "get_context"
+  , "save_context"
 ]
 
 from shutil import rmtree
@@ -47,14 +49,17 @@ from os import (
     unlink,
     listdir,
     getcwd,
-    chdir,
     makedirs
 )
 from os.path import (
+    abspath,
     basename,
+    dirname,
     isdir,
     isfile,
     join,
+    normpath,
+    relpath,
     exists
 )
 from time import (
@@ -70,7 +75,11 @@ import sys
 from common import (
     sloted,
     launch,
-    LaunchFailed
+    CatFilePool,
+    RefReader,
+    LaunchFailed,
+    Journal,
+    pythonize
 )
 from six import (
     b,
@@ -81,21 +90,70 @@ from itertools import (
     chain,
     count
 )
+from collections import deque
+from threading import (
+    local,
+    Thread
+)
+from six.moves.queue import Queue
 
-current_context = None
+# The current context is per thread. So, several contexts can be planned and
+# performed by different threads. Actions keep their contexts (see
+# Action.queue).
+_current = local()
 
 def switch_context(ctx):
-    global current_context
+    """ Sets the context of the calling thread actions are queued to by
+default. Returns previous one.
+    """
+    ret = get_context()
 
-    if current_context is ctx:
+    if ret is ctx:
         raise RuntimeError("Same action context")
 
-    ret = current_context
-    current_context = ctx
+    _current.context = ctx
     return ret
 
 def get_context():
-    return current_context
+    return getattr(_current, "context", None)
+
+def save_context(ctx, file_name):
+    "Writes @ctx to @file_name atomically (see core.load_context)."
+
+    pythonize(ctx, file_name + ".tmp")
+
+    try:
+        # atomic on POSIX, so the state file is never missing
+        rename(file_name + ".tmp", file_name)
+    except OSError:
+        # Windows does not replace files
+        unlink(file_name)
+        rename(file_name + ".tmp", file_name)
+
+def action_record(action):
+    "Returns (type name, fields) of an @action for a journal."
+
+    fields = {}
+    for klass in type(action).__mro__:
+        for attr in getattr(klass, "__slots__", ()):
+            if not attr.startswith("_"):
+                fields[attr] = getattr(action, attr)
+
+    return type(action).__name__, fields
+
+def action_from_record(record):
+    "Creates an action (not queued) by a result of action_record."
+
+    name, fields = record
+
+    classes = [Action]
+    while classes:
+        klass = classes.pop()
+        if klass.__name__ == name:
+            return klass(queue = False, **fields)
+        classes.extend(klass.__subclasses__())
+
+    raise ValueError("Unknown action type " + name)
 
 def csv_excape(cell):
     if b";" in cell:
@@ -138,8 +196,10 @@ raw_stdout = getattr(sys.stdout, 'buffer', sys.stdout)
 raw_stderr = getattr(sys.stderr, 'buffer', sys.stderr)
 
 class ActionContext(sloted):
-    __slots__ = ["_actions", "current_action", "interrupted", "_doing",
-                 "_extra_actions", "_out_log", "_err_log", "_log_io"]
+    __slots__ = ["_done", "_pending", "current_action", "interrupted",
+                 "_doing", "_extra_actions", "_out_log", "_err_log",
+                 "_log_io", "_timings", "_env", "_journal", "_journaled",
+                 "_journaled_env", "_state_file", "_compact_every"]
 
     def __init__(self,
         current_action = -1,
@@ -153,9 +213,25 @@ class ActionContext(sloted):
             **kw
         )
 
-        self._actions = []
+        # Performed actions (first `current_action` ones) and the queue of
+        # pending actions. Actions queued during `do` are put at the head of
+        # the queue.
+        self._done = []
+        self._pending = deque()
         self._extra_actions = []
         self._doing = False
+        # Action type name -> [count, seconds] of actions performed by `do`.
+        # It is not saved with the context.
+        self._timings = {}
+        # Environment variables set by actions (see SetCommitter) for
+        # processes those actions launch. `os.environ` is not changed.
+        self._env = {}
+        # Performed actions are recorded while journaling (see open_journal).
+        self._journal = None
+        self._journaled = 0
+        self._journaled_env = None
+        self._state_file = None
+        self._compact_every = None
 
         self._log_io = None
         # properties is not compatible with slots
@@ -191,68 +267,258 @@ class ActionContext(sloted):
         limit
             Set maximum number of actions to perform. None means unlimited.
         """
-        actions = self._actions
+        done = self._done
+        pending = self._pending
         extra_actions = self._extra_actions
 
-        ca = self.current_action
-        if ca < 0: # start
-            if limit is None:
-                i = enumerate(actions)
-            else:
-                i = enumerate(actions[:limit])
-        elif ca >= len(actions): # all actions were done
+        if self.current_action >= 0 and not pending: # all actions were done
             print("Nothing to do")
             return True
-        # continue the work
-        elif limit is None:
-            i = enumerate(actions[ca:], ca)
-        else:
-            i = enumerate(actions[ca:ca + limit], ca)
+
+        timings = self._timings
 
         self.interrupted = False
         self._doing = True
         ret = True
 
-        while not self.interrupted:
-            # This construction allows to switch i from within loop body. While
-            # the same is wrong for constructions like `for idx, a in i:`.
+        while not self.interrupted and pending:
+            if limit is not None and limit <= 0:
+                break
+
             try:
-                idx, a = next(i)
-            except StopIteration:
+                batch = self.do_batch(limit)
+            except:
+                print("Failed on a batch of actions")
+                print_exc(file = sys.stdout)
+                ret = False
                 break
 
+            if batch:
+                index = len(done)
+                for _ in range(batch):
+                    done.append(pending.popleft())
+                self.__record(index, done[index:], [])
+                if limit is not None:
+                    limit -= batch
+                continue
+
+            if limit is not None:
+                limit -= 1
+
+            a = pending.popleft()
+            # A failed action is not repeated by next `do` too.
+            done.append(a)
+
+            if self._journal is not None:
+                self.record_intent(len(done) - 1, self.journal_intent(a))
+
+            t0 = time()
             try:
                 a()
             except:
                 print("Failed on %s" % a)
                 print_exc(file = sys.stdout)
                 ret = False
+                self.__record(len(done) - 1, [a], [])
                 break
 
-            if extra_actions:
-                next_idx = idx + 1
+            timing = timings.setdefault(type(a).__name__, [0, 0.])
+            timing[0] += 1
+            timing[1] += time() - t0
 
-                while extra_actions:
-                    a = extra_actions.pop()
-                    actions.insert(next_idx, a)
+            extras = list(extra_actions)
+            if extras:
+                # Actions queued by `a` are performed next in queuing order.
+                pending.extendleft(reversed(extras))
+                del extra_actions[:]
 
-                if limit is None:
-                    i = enumerate(actions[next_idx:], next_idx)
-                else:
-                    rest = limit - (next_idx - ca)
-                    i = enumerate(actions[next_idx:next_idx + rest], next_idx)
+            self.__record(len(done) - 1, [a], extras)
 
         self._doing = False
-        self.current_action = idx + 1
+        self.current_action = len(done)
 
         return ret
 
+    def do_batch(self, limit):
+        """ Performs several first pending actions at once (no more than
+@limit if it is not None). Returns the number of performed actions. `do` does
+not call them then. By default, nothing is performed.
+        """
+        return 0
+
+    def open_journal(self, state_file, journal_file,
+        compact_every = 10000,
+        **kw
+    ):
+        """ Starts recording of actions performed by `do` to @journal_file
+(see Journal, @kw are passed to it). So, progress is not lost if the process
+is killed. The context is saved to @state_file (a snapshot) first. Each
+@compact_every records the snapshot is saved again and the journal is
+truncated. After a crash, the context is loaded from the snapshot and the
+journal is applied by `replay`.
+        """
+
+        # actions may change working directory
+        self._state_file = abspath(state_file)
+        self._compact_every = compact_every
+        self._journal = Journal(abspath(journal_file), **kw)
+        self.compact_journal()
+
+    def compact_journal(self):
+        "Saves the snapshot and truncates the journal."
+
+        # The snapshot is marked as started even if nothing is done yet.
+        # Else, a launch after a kill before the first record would plan the
+        # clone again into the loaded context.
+        self.current_action = len(self._done)
+
+        save_context(self, self._state_file)
+        self._journal.truncate()
+        self._journaled = 0
+        self._journaled_env = dict(self._env)
+
+    def close_journal(self):
+        """ Stops journaling and removes the journal. The context must be
+saved (or its state file removed) before.
+        """
+
+        journal = self._journal
+        if journal is None:
+            return
+
+        self._journal = None
+        journal.close()
+        unlink(journal.file_name)
+
+    def __record(self, index, actions, extras):
+        """ Journals @actions performed (starting from @index of performed
+actions) and @extras they queued.
+        """
+
+        journal = self._journal
+        if journal is None:
+            return
+
+        # environment is journaled when changed (e.g., by SetCommitter)
+        env = self._env
+        if env == self._journaled_env:
+            env = None
+        else:
+            self._journaled_env = env = dict(env)
+
+        journal.append((index, len(actions), self.journal_cloned(actions),
+            [action_record(a) for a in extras], env
+        ))
+
+        self._journaled += 1
+        if self._journaled >= self._compact_every:
+            self.compact_journal()
+
+    def record_intent(self, index, intent):
+        """ Journals an @intent (see journal_intent) of the action @index
+which is to be performed.
+        """
+
+        if self._journal is None or intent is None:
+            return
+
+        self._journal.append((index, intent))
+
+    def journal_intent(self, action):
+        """ Returns a literal describing state the @action may change or None.
+If the process is killed while the action is performed, the state is restored
+by replay_intent and the action is repeated.
+        """
+        return None
+
+    def replay_intent(self, intent):
+        "Restores state an action was performed in (see journal_intent)."
+        pass
+
+    def journal_cloned(self, actions):
+        """ Returns results of @actions to journal, a list of literals (see
+replay_cloned).
+        """
+        return []
+
+    def replay_cloned(self, cloned):
+        "Applies results of actions returned by journal_cloned."
+        pass
+
+    def replay(self, records):
+        """ Applies @records of a journal (see open_journal) to the context
+loaded from the snapshot. Records those the snapshot already includes are
+skipped. Returns the number of applied records.
+        """
+
+        done = self._done
+        pending = self._pending
+        applied = 0
+        intent = None
+
+        for record in records:
+            if len(record) == 2:
+                intent = record
+                continue
+
+            index, n, cloned, extras, env = record
+
+            if index + n <= len(done):
+                continue
+
+            if index != len(done) or len(pending) < n:
+                raise ValueError("Journal record of action %d does not match"
+                    " the state, %d actions were done" % (index, len(done))
+                )
+
+            for _ in range(n):
+                done.append(pending.popleft())
+
+            self.replay_cloned(cloned)
+            if env is not None:
+                self._env = dict(env)
+
+            extras = [action_from_record(r) for r in extras]
+            for a in extras:
+                a._ctx = self
+            pending.extendleft(reversed(extras))
+
+            applied += 1
+
+        if intent is not None and intent[0] == len(done):
+            # the process was killed while the action was performed
+            self.replay_intent(intent[1])
+
+        if applied:
+            self.current_action = len(done)
+
+        return applied
+
     @property
     def finished(self):
-        return self.current_action >= len(self._actions)
+        return self.current_action >= len(self._done) + len(self._pending)
+
+    @property
+    def env(self):
+        "Environment for processes launched by actions: a new dictionary."
+        env = dict(environ)
+        env.update(self._env)
+        return env
+
+    @property
+    def actions(self):
+        "List of all actions: performed ones and then pending ones."
+        return list(chain(self._done, self._pending))
+
+    @property
+    def timings(self):
+        """ Maps action type names to (count, seconds) of actions performed
+by this context so far.
+        """
+        return dict((k, tuple(v)) for k, v in self._timings.items())
 
     def __dfs_children__(self):
-        return list(self._actions)
+        return self.actions
 
     def __gen_code__(self, g):
         self.gen_by_slots(g, log = self.log)
@@ -260,34 +526,57 @@ class ActionContext(sloted):
         g.line("switch_context(" + g.nameof(self) + ")")
         g.line()
         g.write("actions = ")
-        g.pprint(self._actions)
+        g.pprint(self.actions)
         g.line()
         g.line()
         g.line("for a in actions:")
         g.line("    a.q()")
 
+        if self._env:
+            # set by actions performed, e.g. SetCommitter
+            g.line()
+            g.write(g.nameof(self) + "._env = ")
+            g.pprint(self._env)
+            g.line()
+
 cache_file_re = compile("[A-Fa-f0-9]{40}.*")
 
 class GitContext(ActionContext):
     __slots__ = ["_sha2commit", "src_repo_path", "_origin2cloned",
                  "git_command", "_git_version", "cache_path", "_cache",
-                 "from_cache"]
+                 "from_cache", "merge_tree", "fast_import", "_stale_worktree",
+                 "_cat_files", "_refs", "_replaced"]
 
     def __init__(self,
         git_command = "git",
         cache_path = None,
         from_cache = False,
+        merge_tree = False,
+        fast_import = False,
         **kw
     ):
         super(GitContext, self).__init__(
             git_command = git_command,
             cache_path = cache_path,
             from_cache = from_cache,
+            merge_tree = merge_tree,
+            fast_import = fast_import,
             **kw
         )
 
         self._sha2commit = {}
         self._origin2cloned = {}
+        # Path of the repository whose HEAD was moved by `update-ref` while
+        # its index and working tree were not updated.
+        self._stale_worktree = None
+        # Object and reference queries are answered by `git cat-file`
+        # processes those live while actions are performed.
+        self._cat_files = CatFilePool(self.git_command)
+        # HEAD is resolved by reading files in `.git`.
+        self._refs = RefReader(self.git_command)
+        # The number of process launches made before the two above were
+        # introduced by queries they answered (see saved_spawns).
+        self._replaced = 0
 
         # get version of git
         _stdout, _stderr = launch([self.git_command, "--version"],
@@ -297,6 +586,12 @@ class GitContext(ActionContext):
         _, _, version = _stdout.split(b" ")[:3]
         self._git_version = tuple(int(v) for v in version.split(b".")[:3])
 
+        if merge_tree and self._git_version < (2, 38, 0):
+            print("git merge-tree --write-tree requires git 2.38 at least. "
+                "Commits will be created in the working tree."
+            )
+            self.merge_tree = False
+
         # walk cache_path and fill _cahce
         self._cache = cache = {}
 
@@ -339,6 +634,589 @@ class GitContext(ActionContext):
             .replace("}", "\n}")
         )
 
+    def provide_worktree(self):
+        """ Updates index and working tree to HEAD if commits were created
+without them (see `merge_tree`).
+        """
+
+        path = self._stale_worktree
+        if path is None:
+            return
+
+        launch([self.git_command, "-C", path, "reset", "-q", "--hard"],
+            epfx = "Cannot update working tree of '%s'" % path
+        )
+        self._stale_worktree = None
+
+    def interrupt(self):
+        # a user will work with the working tree
+        self.provide_worktree()
+        ActionContext.interrupt(self)
+
+    def do(self, *a, **kw):
+        ret = ActionContext.do(self, *a, **kw)
+        # the working tree must be consistent between launches
+        self.provide_worktree()
+        self._cat_files.close()
+        return ret
+
+    @property
+    def saved_spawns(self):
+        """ Number of process launches saved by `git cat-file` processes and
+reading of references: launches queries replaced (several queries can replace
+one launch) minus processes started for queries.
+        """
+        return (self._replaced - self._cat_files.spawns
+            - self._refs.fallbacks
+        )
+
+    def do_batch(self, limit):
+        """ If `fast_import` is set, a stretch of cherry-picks those results
+are fully determined is streamed to one `git fast-import` process.
+        """
+
+        if not self.fast_import:
+            return 0
+
+        units = self.__find_stretch(limit)
+        if not units:
+            return 0
+
+        t0 = time()
+
+        try:
+            units = self.__import_stretch(units)
+        except LaunchFailed:
+            # queries of objects, HEAD is not moved yet
+            print("Cannot import commits, they will be cherry-picked")
+            print_exc(file = sys.stdout)
+            return 0
+
+        if not units:
+            return 0
+
+        timing = self._timings.setdefault("CherryPick", [0, 0.])
+        timing[0] += len(units)
+        timing[1] += time() - t0
+
+        return sum(len(u) for u in units)
+
+    def __find_stretch(self, limit):
+        """ Looks for SetCommitter, CherryPick, ResetCommitter sequences at the
+beginning of pending actions. Each can be followed by CreateHead and
+CreateTag actions. Returns a list of the sequences (units).
+        """
+
+        units = []
+        path = None
+
+        i = iter(self._pending)
+        a = next(i, None)
+
+        while type(a) is SetCommitter:
+            if limit is not None and limit < 3:
+                break
+
+            pick, reset = next(i, None), next(i, None)
+            if type(pick) is not CherryPick or type(reset) is not ResetCommitter:
+                break
+
+            if path is None:
+                path = pick.path
+            elif pick.path != path:
+                break
+
+            unit = [a, pick, reset]
+            if limit is not None:
+                limit -= 3
+
+            a = next(i, None)
+            while type(a) in (CreateHead, CreateTag) and a.path == path:
+                if limit is not None:
+                    if limit < 1:
+                        break
+                    limit -= 1
+
+                unit.append(a)
+                a = next(i, None)
+
+            units.append(unit)
+
+        return units
+
+    def __import_stretch(self, units):
+        """ Imports first @units whose results are fully determined: the
+original parent of the first commit has same tree as HEAD and each next
+commit is a child of the previous one. So, original trees are used as is.
+Returns list of imported units.
+        """
+
+        git = self.git_command
+        path = units[0][1].path
+        sha2commit = self._sha2commit
+
+        shas = [units[0][1].commit_sha]
+        for unit in units[1:]:
+            sha = unit[1].commit_sha
+            parents = sha2commit[sha].parents
+            if len(parents) != 1 or parents[0].sha != shas[-1]:
+                break
+            shas.append(sha)
+
+        parents = sha2commit[shas[0]].parents
+        if len(parents) > 1:
+            return []
+
+        objects = self._cat_files
+
+        # None if there is no commits in current branch yet
+        head = self._refs.resolve(path)
+        # `git rev-parse` of HEAD and trees
+        self._replaced += 1
+
+        if parents:
+            if head is None:
+                return []
+            if (objects.sha(path, parents[0].sha + "^{tree}")
+             != objects.sha(path, "HEAD^{tree}")
+            ):
+                return []
+        elif head is not None:
+            # The commit is a root but it would not be in the copy.
+            return []
+
+        # `git cat-file --batch` of all commits
+        self._replaced += 1
+
+        commits = []
+        for sha in shas:
+            _, _, content = objects.read(path, sha)
+
+            header, _, message = content.partition(b"\n\n")
+
+            fields = {}
+            for line in header.split(b"\n"):
+                key, _, value = line.partition(b" ")
+                fields[key] = value
+
+            # E.g., `encoding` or `gpgsig` cannot be reproduced by this way.
+            if set(fields) - set([b"tree", b"parent", b"author",
+                b"committer"]
+            ):
+                break
+
+            commits.append((fields[b"tree"], fields[b"author"], message))
+
+        units = units[:len(commits)]
+        if not units:
+            return []
+
+        # References are shared by linked working trees (see do_parallel).
+        # So, each one imports to its own reference.
+        git_dir = units[0][1].git_dir()
+        ref = b"refs/gic/fast-import"
+        if basename(dirname(normpath(git_dir))) == "worktrees":
+            ref += b"-" + basename(normpath(git_dir)).encode("utf-8")
+
+        stream = [b"reset " + ref + b"\n"]
+        if head is not None:
+            stream.append(b"from " + head + b"\n")
+        stream.append(b"\n")
+
+        for mark, (unit, (tree, author, message)) in enumerate(
+            zip(units, commits), 1
+        ):
+            sc = unit[0]
+            committer = "%s <%s> %s" % (sc.committer_name, sc.committer_email,
+                raw_date(sc.committed_date, sc.committer_tz_offset)
+            )
+            stream.append(b"commit " + ref + b"\n"
+                + b"mark :%d\n" % mark
+                + b"author " + author + b"\n"
+                + b"committer " + committer.encode("utf-8") + b"\n"
+                + b"data %d\n" % len(message) + message + b"\n"
+                + b"deleteall\n"
+                + b"M 040000 " + tree + b' ""\n\n'
+            )
+
+            for a in unit[3:]:
+                if type(a) is CreateHead:
+                    head_ref = "refs/heads/" + a.name
+                else:
+                    head_ref = "refs/tags/" + a.name
+                stream.append(b"reset " + head_ref.encode("utf-8") + b"\n"
+                    + b"from :%d\n\n" % mark
+                )
+
+        marks_file = join(git_dir, "gic-fast-import-marks")
+
+        self.record_intent(len(self._done), (path, head))
+
+        # Commits are cherry-picked if the stretch cannot be imported. It's
+        # only safe until HEAD is moved.
+        try:
+            launch([git, "-C", path, "fast-import", "--quiet", "--force",
+                    "--export-marks=" + marks_file
+                ],
+                input = b"".join(stream)
+            )
+
+            f = open(marks_file, "rb")
+            marks = dict(l.split(b" ") for l in f.read().split(b"\n") if l)
+            f.close()
+            unlink(marks_file)
+
+            launch([git, "-C", path, "update-ref", "HEAD",
+                marks[b":%d" % len(units)]
+            ])
+        except (LaunchFailed, IOError, OSError, KeyError):
+            print("Cannot import commits, they will be cherry-picked")
+            print_exc(file = sys.stdout)
+            return []
+
+        self._stale_worktree = path
+
+        for mark, unit in enumerate(units, 1):
+            sha2commit[unit[1].commit_sha].cloned_sha = marks[b":%d" % mark]
+
+        # The stretch is imported, the temporary reference is just garbage.
+        try:
+            launch([git, "-C", path, "update-ref", "-d", ref])
+        except LaunchFailed as e:
+            print("Cannot remove %s: %s" % (u(ref), u(e._stderr).strip()))
+
+        # Committer environment variables are not set after the stretch.
+        units[-1][2]()
+
+        return units
+
+    def do_parallel(self, jobs):
+        """ Performs actions like `do` but independent branches are cloned by
+@jobs threads in linked working trees (`git worktree`) of the destination.
+
+Actions are split into segments at CheckoutCloned and CheckoutOrphan actions
+(see split_segments). A segment is started when segments creating commits it
+checks out or merges are finished. Segments with planned interruptions and
+the ones depending on them are left to `do`. If a segment fails or is
+interrupted (e.g. by conflicts) then no more segments are started and the
+failed one is repeated by `do` in the working tree of the destination.
+        """
+
+        if self._git_version < (2, 17, 0):
+            print("git worktree remove requires git 2.17 at least. "
+                "Branches will be cloned serially."
+            )
+            return self.do()
+
+        prologue, _, _ = split_segments(self._pending)
+        if prologue:
+            ret = self.do(limit = len(prologue))
+            if not ret or self.interrupted:
+                return ret
+
+        prologue, segments, tail = split_segments(self._pending)
+        if prologue or not segments:
+            return self.do()
+
+        path = segments[0][0].path
+        if self._refs.resolve(path) is None:
+            # nothing to start working trees with
+            return self.do()
+
+        finished = self.__do_segments(path, segments, tail, jobs)
+        pending = self._pending
+
+        if self._journal is not None:
+            self.compact_journal()
+
+        print("%d of %d branches were cloned by %d threads" % (
+            len(finished), len(segments), jobs
+        ))
+
+        if not pending:
+            return True
+
+        return self.do()
+
+    def __do_segments(self, path, segments, tail, jobs):
+        """ Performs @segments in parallel, see do_parallel. Returns a dict
+mapping indices of finished segments to lists of performed actions. Those
+actions are moved to performed ones. Actions of other segments and @tail are
+left pending. While journaling, the context is saved each time a segment is
+finished.
+        """
+
+        git = self.git_command
+        sha2commit = self._sha2commit
+
+        # commit -> index of the segment creating it
+        producers = {}
+        for i, segment in enumerate(segments):
+            for a in segment:
+                if isinstance(a, COMMITTING_ACTIONS):
+                    producers[a.commit_sha] = i
+
+        dependencies = [0] * len(segments)
+        dependents = [[] for _ in segments]
+        serial = set()
+
+        for i, segment in enumerate(segments):
+            deps = set()
+
+            for a in segment:
+                if isinstance(a, SERIAL_ACTIONS):
+                    serial.add(i)
+
+                if isinstance(a, CheckoutCloned):
+                    shas = [a.commit_sha]
+                elif isinstance(a, MergeCloned):
+                    shas = a.extra_parents
+                elif isinstance(a, SubtreeMerge):
+                    shas = [a.parent_sha]
+                else:
+                    continue
+
+                for sha in shas:
+                    j = producers.get(sha, None)
+                    if j is not None and j != i:
+                        deps.add(j)
+
+            dependencies[i] = len(deps)
+            for j in deps:
+                dependents[j].append(i)
+
+        # Branches are updated in linked working trees. So, no branch must be
+        # checked out here.
+        launch([git, "-C", path, "checkout", "-q", "--detach"],
+            epfx = "Cannot detach HEAD of '%s'" % path
+        )
+
+        worktrees_dir = join(self.git_dir(path), "gic-worktrees")
+
+        def remove_worktrees():
+            if exists(worktrees_dir):
+                for name in listdir(worktrees_dir):
+                    wt = join(worktrees_dir, name)
+                    try:
+                        launch([git, "-C", path, "worktree", "remove",
+                            "--force", "--force", wt
+                        ])
+                    except LaunchFailed:
+                        rmtree(wt)
+
+            launch([git, "-C", path, "worktree", "prune"])
+            if exists(worktrees_dir):
+                rmtree(worktrees_dir)
+
+        # left by a killed process
+        if exists(worktrees_dir):
+            remove_worktrees()
+
+            # Segments are repeated from scratch.
+            for segment in segments:
+                if isinstance(segment[0], CheckoutOrphan):
+                    try:
+                        launch([git, "-C", path, "branch", "-D",
+                            segment[0].name
+                        ])
+                    except LaunchFailed:
+                        pass # it was not created
+
+        done = list(self._done)
+        finished = {}
+
+        def arrange():
+            self._done = done + list(chain(*(
+                finished[i] for i in sorted(finished)
+            )))
+            pending = deque()
+            for i, segment in enumerate(segments):
+                if i not in finished:
+                    pending.extend(segment)
+            pending.extend(tail)
+            self._pending = pending
+            self.current_action = len(self._done)
+
+        tasks = Queue()
+        results = Queue()
+
+        def worker(worktree):
+            created = False
+
+            while True:
+                i = tasks.get()
+                if i is None:
+                    break
+
+                child = self.fork()
+
+                try:
+                    if not created:
+                        launch([git, "-C", path, "worktree", "add", "--detach",
+                            worktree
+                        ])
+                        created = True
+
+                    ok = child.do_segment(segments[i], worktree)
+                except:
+                    print("Failed on a segment of actions")
+                    print_exc(file = sys.stdout)
+                    ok = False
+
+                results.put((i, child, ok))
+
+        worktrees = [join(worktrees_dir, str(n)) for n in range(jobs)]
+        threads = [Thread(target = worker, args = (wt,)) for wt in worktrees]
+        for t in threads:
+            t.start()
+
+        running = 0
+        for i, deps in enumerate(dependencies):
+            if not deps and i not in serial:
+                tasks.put(i)
+                running += 1
+
+        failed = []
+
+        while running:
+            i, child, ok = results.get()
+            running -= 1
+
+            self.__join(child)
+
+            if not ok:
+                print("The branch will be cloned again in '%s'" % path)
+                failed.append(i)
+                continue
+
+            # Actions of the segment and actions queued by them belong to this
+            # context now.
+            for a in child._done:
+                a._ctx = self
+                if isinstance(a, GitAction):
+                    a.path = path
+
+            finished[i] = child._done
+
+            if self._journal is not None:
+                arrange()
+                self.compact_journal()
+
+            if failed:
+                # do not start new segments
+                continue
+
+            for j in dependents[i]:
+                dependencies[j] -= 1
+                if not dependencies[j] and j not in serial:
+                    tasks.put(j)
+                    running += 1
+
+        for t in threads:
+            tasks.put(None)
+        for t in threads:
+            t.join()
+
+        remove_worktrees()
+
+        arrange()
+
+        # Failed segments are repeated from scratch.
+        for i in failed:
+            segment = segments[i]
+
+            for a in segment:
+                a._ctx = self
+                if isinstance(a, GitAction):
+                    a.path = path
+                if isinstance(a, COMMITTING_ACTIONS):
+                    sha2commit[a.commit_sha].cloned_sha = None
+
+            if isinstance(segment[0], CheckoutOrphan):
+                try:
+                    launch([git, "-C", path, "branch", "-D", segment[0].name])
+                except LaunchFailed:
+                    pass # it was not created
+
+        return finished
+
+    def git_dir(self, path):
+        "Returns the git directory of the working tree @path."
+        git_dir, _ = self._refs.git_dirs(path)
+        if git_dir is None:
+            _stdout, _ = launch([self.git_command, "-C", path, "rev-parse",
+                "--git-dir"
+            ])
+            git_dir = join(path, _stdout.strip().decode("utf-8"))
+        return git_dir
+
+    def fork(self):
+        """ Returns an empty context with same options (e.g., to perform
+actions of this one in another thread). The graph, the cache and the log are
+shared.
+        """
+
+        child = object.__new__(type(self))
+
+        for name in ["src_repo_path", "git_command", "_git_version",
+            "cache_path", "_cache", "from_cache", "merge_tree", "fast_import",
+            "_sha2commit", "_origin2cloned", "_out_log", "_err_log"
+        ]:
+            setattr(child, name, getattr(self, name))
+
+        child.current_action = -1
+        child.interrupted = False
+        child._done = []
+        child._pending = deque()
+        child._extra_actions = []
+        child._doing = False
+        child._timings = {}
+        child._env = {}
+        child._journal = None
+        child._journaled = 0
+        child._journaled_env = None
+        child._state_file = None
+        child._compact_every = None
+        child._log_io = None
+        child._stale_worktree = None
+        child._cat_files = CatFilePool(self.git_command)
+        child._refs = RefReader(self.git_command)
+        child._replaced = 0
+
+        return child
+
+    def do_segment(self, actions, worktree):
+        """ Performs copies of @actions in the @worktree. Returns True if all
+actions (including ones they queued) are performed.
+        """
+
+        # @actions are left as is to be saved with their context.
+        actions = [action_from_record(action_record(a)) for a in actions]
+
+        for a in actions:
+            a._ctx = self
+            if isinstance(a, GitAction):
+                a.path = worktree
+
+        self._pending.extend(actions)
+
+        return self.do() and not self.interrupted and not self._pending
+
+    def __join(self, child):
+        "Accumulates statistics of a context returned by fork."
+
+        timings = self._timings
+        for name, (n, seconds) in child._timings.items():
+            timing = timings.setdefault(name, [0, 0.])
+            timing[0] += n
+            timing[1] += seconds
+
+        self._cat_files.queries += child._cat_files.queries
+        self._cat_files.spawns += child._cat_files.spawns
+        self._refs.reads += child._refs.reads
+        self._refs.fallbacks += child._refs.fallbacks
+        self._replaced += child._replaced
+
     def __backup_cloned(self):
         origin2cloned = {}
 
@@ -355,16 +1233,78 @@ class GitContext(ActionContext):
     def plan_set_commiter_by_env(self):
         "Inserts SetCommitter action getting its parameters from environment."
 
+        env = self.env
         committed_date, committer_tz_offset = gds2so(
-            environ["GIT_COMMITTER_DATE"]
+            env["GIT_COMMITTER_DATE"]
         )
         SetCommitter(
-            committer_name = environ["GIT_COMMITTER_NAME"],
-            committer_email = environ["GIT_COMMITTER_EMAIL"],
+            committer_name = env["GIT_COMMITTER_NAME"],
+            committer_email = env["GIT_COMMITTER_EMAIL"],
             committed_date = committed_date,
-            committer_tz_offset = committer_tz_offset
+            committer_tz_offset = committer_tz_offset,
+            ctx = self
         )
 
+    def journal_intent(self, action):
+        """ HEAD is journaled before an automatic commit. ContinueCommitting
+is not repeated because a user could resolve conflicts for it.
+        """
+
+        if (isinstance(action, COMMITTING_ACTIONS)
+        and not isinstance(action, ContinueCommitting)
+        ):
+            return action.path, self._refs.resolve(action.path)
+
+        return None
+
+    def replay_intent(self, intent):
+        "Moves HEAD back if the commit was created."
+
+        path, head = intent
+
+        if self._refs.resolve(path) == head:
+            return
+
+        print("Rolling back HEAD of '%s' to repeat the interrupted commit"
+            % path
+        )
+
+        if head is None:
+            launch([self.git_command, "-C", path, "update-ref", "-d", "HEAD"],
+                epfx = "Cannot remove HEAD of '%s'" % path
+            )
+            launch([self.git_command, "-C", path, "rm", "-r", "-q", "-f",
+                    "--ignore-unmatch", "."
+                ],
+                epfx = "Cannot clean working tree of '%s'" % path
+            )
+        else:
+            launch([self.git_command, "-C", path, "reset", "-q", "--hard",
+                    head.decode("utf-8")
+                ],
+                epfx = "Cannot reset HEAD of '%s'" % path
+            )
+
+    def journal_cloned(self, actions):
+        "Journals SHA1s of commits cloned by @actions."
+
+        sha2commit = self._sha2commit
+        cloned = []
+
+        for a in actions:
+            sha = getattr(a, "commit_sha", None)
+            if sha is None or sha not in sha2commit:
+                continue
+
+            cloned_sha = sha2commit[sha].cloned_sha
+            if cloned_sha is not None:
+                cloned.append((sha, cloned_sha))
+
+        return cloned
+
+    def replay_cloned(self, cloned):
+        self._origin2cloned.update(cloned)
+
     def restore_cloned(self):
         sha2commit = self._sha2commit
 
@@ -390,6 +1330,15 @@ def dt(ts, off):
         ret = ret + ("-%02d%02d" % (off / 3600, (off / 60) % 60))
     return ret
 
+def raw_date(ts, off):
+    "Formats a date like `dt` but in Git internal format."
+    ret = "%d " % ts
+    if off <= 0:
+        ret = ret + ("+%02d%02d" % (-off // 3600, (-off // 60) % 60))
+    else:
+        ret = ret + ("-%02d%02d" % (off // 3600, (off // 60) % 60))
+    return ret
+
 def gds2so(gds):
     "Git Date String To Seconds since epoch and time zone Offset"
     offset_str = gds[-5:]
@@ -407,34 +1356,65 @@ def gds2so(gds):
 
     return (ts, offset)
 
+def stripspace(text):
+    """ Cleans up a commit message like `git stripspace` (without comments
+removing) does.
+    """
+    lines = []
+    for line in text.split("\n"):
+        line = line.rstrip(" \t\r\v\f")
+        if line or (lines and lines[-1]):
+            lines.append(line)
+
+    while lines and not lines[-1]:
+        lines.pop()
+
+    return "".join(l + "\n" for l in lines)
+
+def split_ident(ident):
+    "Splits `Name <e-mail> date` line of a commit header (bytes)."
+
+    email_end = ident.rindex(b">")
+    email_start = ident.rindex(b"<", 0, email_end)
+    return (
+        ident[:email_start].rstrip(b" "),
+        ident[email_start + 1:email_end],
+        ident[email_end + 1:].strip()
+    )
+
 class Action(sloted):
     __slots__ = ["_ctx"]
 
-    def __init__(self, queue = True, ** kw):
+    def __init__(self, queue = True, ctx = None, ** kw):
         """
-        @queue: auto add the action to queue of the current action context
+        @queue: auto add the action to queue of the action context
+        @ctx: the action context, the current one of the thread by default
         """
         super(Action, self).__init__(**kw)
 
         self._ctx = None
         if queue:
-            self.q()
+            self.q(ctx)
 
-    def queue(self):
+    def queue(self, ctx = None):
         if self._ctx is not None:
             raise RuntimeError("Already in the action context")
 
-        global current_context
+        if ctx is None:
+            ctx = get_context()
 
-        if current_context is None:
-            raise RuntimeError("No action context set")
+            if ctx is None:
+                raise RuntimeError("No action context set")
 
-        if current_context._doing:
-            current_context._extra_actions.append(self)
+        if ctx._doing:
+            ctx._extra_actions.append(self)
+        elif len(ctx._done) < ctx.current_action:
+            # The context is being loaded, see ActionContext.__gen_code__.
+            ctx._done.append(self)
         else:
-            current_context._actions.append(self)
+            ctx._pending.append(self)
 
-        self._ctx = current_context
+        self._ctx = ctx
 
     q = queue
 
@@ -485,52 +1465,49 @@ class SetCommitter(Action):
                  "committer_tz_offset"]
 
     def __call__(self):
-        environ["GIT_COMMITTER_NAME"] = self.committer_name
-        environ["GIT_COMMITTER_EMAIL"] = self.committer_email
-        environ["GIT_COMMITTER_DATE"] = dt(self.committed_date,
+        env = self._ctx._env
+        env["GIT_COMMITTER_NAME"] = self.committer_name
+        env["GIT_COMMITTER_EMAIL"] = self.committer_email
+        env["GIT_COMMITTER_DATE"] = dt(self.committed_date,
             self.committer_tz_offset
         )
 
 class ResetCommitter(Action):
     def __call__(self):
-        try:
-            del environ["GIT_COMMITTER_NAME"]
-            del environ["GIT_COMMITTER_EMAIL"]
-            del environ["GIT_COMMITTER_DATE"]
-        except KeyError:
-            # If process was interrupted the env. var. values are lost.
-            pass
+        env = self._ctx._env
+        # If process was interrupted the env. var. values are lost.
+        env.pop("GIT_COMMITTER_NAME", None)
+        env.pop("GIT_COMMITTER_EMAIL", None)
+        env.pop("GIT_COMMITTER_DATE", None)
 
 class SetAuthor(Action):
     __slots__ = ["author_name", "author_email", "authored_date",
                  "author_tz_offset"]
 
     def __call__(self):
-        environ["GIT_AUTHOR_NAME"] = self.author_name
-        environ["GIT_AUTHOR_EMAIL"] = self.author_email
-        environ["GIT_AUTHOR_DATE"] = dt(self.authored_date,
+        env = self._ctx._env
+        env["GIT_AUTHOR_NAME"] = self.author_name
+        env["GIT_AUTHOR_EMAIL"] = self.author_email
+        env["GIT_AUTHOR_DATE"] = dt(self.authored_date,
             self.author_tz_offset
         )
 
 class ResetAuthor(Action):
     def __call__(self):
-        try:
-            del environ["GIT_AUTHOR_NAME"]
-            del environ["GIT_AUTHOR_EMAIL"]
-            del environ["GIT_AUTHOR_DATE"]
-        except KeyError:
-            pass
+        env = self._ctx._env
+        env.pop("GIT_AUTHOR_NAME", None)
+        env.pop("GIT_AUTHOR_EMAIL", None)
+        env.pop("GIT_AUTHOR_DATE", None)
 
 class GitAction(Action):
     __slots__ = ["path", "_stdout", "_stderr"]
 
-    def launch(self, *cmd_args):
-        cwd = getcwd()
+    """ Commands are launched in the working tree (`path`) with the
+environment of the context (see ActionContext.env).
+    """
 
-        if cwd != self.path:
-            chdir(self.path)
-
-        out, err = launch(cmd_args)
+    def launch(self, *cmd_args):
+        out, err = launch(cmd_args, cwd = self.path, env = self._ctx.env)
         if out:
             self._out(out)
         if err:
@@ -539,16 +1516,52 @@ class GitAction(Action):
     def git(self, *cmd_args):
         self.launch(*((self._ctx.git_command,) + cmd_args))
 
-    def git2(self, *cmd_args):
-        cwd = getcwd()
-
-        if cwd != self.path:
-            chdir(self.path)
+    def git2(self, *cmd_args, **kw):
+        if kw.get("env", None) is None:
+            kw["env"] = self._ctx.env
 
         self._stdout, self._stderr = launch(
-            (self._ctx.git_command,) + cmd_args
+            (self._ctx.git_command,) + cmd_args,
+            cwd = self.path,
+            **kw
         )
 
+    def git_dir(self):
+        """ Returns the git directory of the working tree: `.git` or the one
+of a linked working tree (see `git help worktree`).
+        """
+        git_dir, _ = self._ctx._refs.git_dirs(self.path)
+        if git_dir is None:
+            self.git2("rev-parse", "--git-dir")
+            git_dir = join(self.path, self._stdout.strip().decode("utf-8"))
+        return git_dir
+
+    def head_sha(self):
+        "Returns SHA1 of HEAD or None if current branch has no commits yet."
+        ctx = self._ctx
+        # `git rev-parse`
+        ctx._replaced += 1
+        return ctx._refs.resolve(self.path)
+
+    def commit_tree(self, tree, parents, message, env = None):
+        """ Creates a commit by `git commit-tree` and moves HEAD to it by
+`git update-ref`. The index and the working tree are not updated (see
+GitContext.provide_worktree). Author and committer are taken from @env
+(ActionContext.env by default). @message is bytes. Returns SHA1 of the commit.
+        """
+
+        cmd_args = ["commit-tree", tree]
+        for p in parents:
+            cmd_args.extend(("-p", p))
+
+        self.git2(*cmd_args, input = message, env = env)
+        sha = self._stdout.strip()
+
+        self.git("update-ref", "HEAD", sha)
+        self._ctx._stale_worktree = self.path
+
+        return sha
+
     def get_conflicts(self):
         self.git2("diff", "--name-only", "--diff-filter=U")
         # get conflicts skipping empty lines
@@ -584,9 +1597,12 @@ class CheckoutCloned(GitAction):
     __slots__ = ["commit_sha"]
 
     def __call__(self):
-        commit = self._ctx._sha2commit[self.commit_sha]
+        ctx = self._ctx
+        commit = ctx._sha2commit[self.commit_sha]
 
         self.git("checkout", "-f", commit.cloned_sha)
+        # index and working tree are overwritten
+        ctx._stale_worktree = None
 
 class CheckoutOrphan(GitAction):
     __slots__ = [ "name" ]
@@ -608,6 +1624,8 @@ class CheckoutOrphan(GitAction):
             elif isdir(file_path):
                 rmtree(file_path)
 
+        self._ctx._stale_worktree = None
+
 MSG_MNG_CNFLCT_BY_SFL = """\
 Try to manage it by self. Non-resolved conflicts will be taken from the \
 original repository automatically after continuing. \
@@ -626,6 +1644,14 @@ class MergeCloned(GitAction):
             sha2commit[p] for p in self.extra_parents
         ]
 
+        if ctx.merge_tree:
+            cloned_sha = self.merge_without_worktree(extra_parents)
+            if cloned_sha is not None:
+                commit.cloned_sha = cloned_sha
+                return
+
+        ctx.provide_worktree()
+
         try:
             self.git("merge",
                 "--no-ff",
@@ -653,34 +1679,77 @@ class MergeCloned(GitAction):
                 ApplyCacheOrInterrupt(
                     path = self.path,
                     commit_sha = commit.sha,
-                    reason = reason
+                    reason = reason,
+                    ctx = ctx
                 )
             else:
                 # try to resolve conflicts using the cache
                 if ctx.cache_path:
-                    ApplyCache(path = self.path, commit_sha = commit.sha)
+                    ApplyCache(path = self.path, commit_sha = commit.sha,
+                        ctx = ctx
+                    )
                 # let user to resolve conflict by self
-                Interrupt(reason = reason)
+                Interrupt(reason = reason, ctx = ctx)
 
             # preserve original committer information
             ctx.plan_set_commiter_by_env()
             ContinueCommitting(
                 path = self.path,
-                commit_sha = self.commit_sha
+                commit_sha = self.commit_sha,
+                ctx = ctx
             )
-            ResetCommitter()
+            ResetCommitter(ctx = ctx)
             if ctx.cache_path:
-                UpdateCache(path = self.path, commit_sha = commit.sha)
+                UpdateCache(path = self.path, commit_sha = commit.sha,
+                    ctx = ctx
+                )
             return
 
-        self.git2("rev-parse", "HEAD")
-        commit.cloned_sha = self._stdout.split(b"\n")[0]
+        commit.cloned_sha = self.head_sha()
+
+    def merge_without_worktree(self, extra_parents):
+        """ Creates the merge commit using `git merge-tree --write-tree`.
+Returns SHA1 of the commit or None if it must be created in the working tree
+(conflicts, octopus merge, etc.).
+        """
+
+        if len(extra_parents) != 1:
+            return None
+
+        head = self.head_sha()
+        if head is None:
+            return None
+
+        parent = extra_parents[0].cloned_sha
+
+        try:
+            self.git2("merge-base", "--is-ancestor", parent, head)
+        except LaunchFailed:
+            pass
+        else:
+            # `git merge` does not create a commit in this case
+            return None
+
+        try:
+            self.git2("merge-tree", "--write-tree", head, parent)
+        except LaunchFailed:
+            return None
+
+        tree = self._stdout.split(b"\n")[0]
+
+        # `git merge -m` cleans the message up
+        return self.commit_tree(tree, [head, parent],
+            stripspace(self.message).encode("utf-8")
+        )
 
 class ContinueCommitting(GitAction):
     __slots__ = ["commit_sha"]
 
     def __call__(self):
-        sha2commit = self._ctx._sha2commit
+        ctx = self._ctx
+        ctx.provide_worktree()
+
+        sha2commit = ctx._sha2commit
         commit = sha2commit[self.commit_sha]
 
         # The behavior differs for merge commit completion and existing commit
@@ -688,7 +1757,7 @@ class ContinueCommitting(GitAction):
         # Determine kind of commit to continue by presence of MERGE_MSG file.
         # Note that cherry picked commits with conflicts do store original
         # message into this file too.
-        merge_msg_path = join(self.path, ".git", "MERGE_MSG")
+        merge_msg_path = join(self.git_dir(), "MERGE_MSG")
         merging = isfile(merge_msg_path)
 
         if merging:
@@ -705,8 +1774,7 @@ class ContinueCommitting(GitAction):
             # ensure that committer name, e-mail and date are correct.
             self.git("commit", "--allow-empty", "--no-edit", "--amend")
 
-        self.git2("rev-parse", "HEAD")
-        commit.cloned_sha = self._stdout.split(b"\n")[0]
+        commit.cloned_sha = self.head_sha()
 
 class SubtreeMerge(GitAction):
     __slots__ = ["commit_sha", "message", "parent_sha", "prefix"]
@@ -719,6 +1787,8 @@ class SubtreeMerge(GitAction):
         prefix = self.prefix
         parent = sha2commit[self.parent_sha]
 
+        ctx.provide_worktree()
+
         if ctx._git_version >= (2, 9, 0):
             self.git("merge", "-s", "ours", "--no-commit",
                 "--allow-unrelated-histories", parent.cloned_sha
@@ -726,9 +1796,12 @@ class SubtreeMerge(GitAction):
         else:
             self.git("merge", "-s", "ours", "--no-commit", parent.cloned_sha)
 
-        if exists(".gic"):
-            rmtree(".gic")
-        makedirs(".gic")
+        path = self.path
+        gic_dir = join(path, ".gic")
+
+        if exists(gic_dir):
+            rmtree(gic_dir)
+        makedirs(gic_dir)
 
         self.git("read-tree",
             "--prefix", ".gic/",
@@ -736,14 +1809,18 @@ class SubtreeMerge(GitAction):
             parent.cloned_sha
         )
 
-        if exists(prefix):
-            rmtree(prefix)
+        prefix_dir = join(path, prefix)
+        if exists(prefix_dir):
+            rmtree(prefix_dir)
+
+        makedirs(prefix_dir)
 
-        makedirs(prefix)
+        for root, dirs, files in walk(gic_dir):
+            # relative to the working tree, i.e. starts with ".gic"
+            root = relpath(root, path)
 
-        for root, dirs, files in walk(".gic"):
             for d in dirs:
-                target_dir = join(prefix + root[5:], d)
+                target_dir = join(path, prefix + root[5:], d)
 
                 if not exists(target_dir):
                     makedirs(target_dir)
@@ -754,12 +1831,11 @@ class SubtreeMerge(GitAction):
                     join(prefix + root[5:], f)
                 )
 
-        rmtree(".gic")
+        rmtree(gic_dir)
 
         self.git("commit", "-m", message)
 
-        self.git2("rev-parse", "HEAD")
-        commit.cloned_sha = self._stdout.split(b"\n")[0]
+        commit.cloned_sha = self.head_sha()
 
 class CherryPick(GitAction):
     __slots__ = ["commit_sha", "message"]
@@ -768,6 +1844,14 @@ class CherryPick(GitAction):
         ctx = self._ctx
         c = ctx._sha2commit[self.commit_sha]
 
+        if ctx.merge_tree:
+            cloned_sha = self.pick_without_worktree()
+            if cloned_sha is not None:
+                c.cloned_sha = cloned_sha
+                return
+
+        ctx.provide_worktree()
+
         try:
             self.git("cherry-pick", c.sha)
         except LaunchFailed as e:
@@ -793,28 +1877,102 @@ class CherryPick(GitAction):
                     ApplyCacheOrInterrupt(
                         path = self.path,
                         commit_sha = c.sha,
-                        reason = reason
+                        reason = reason,
+                        ctx = ctx
                     )
                 else:
                     # try to resolve conflicts using the cache
                     if ctx.cache_path:
-                        ApplyCache(path = self.path, commit_sha = c.sha)
+                        ApplyCache(path = self.path, commit_sha = c.sha,
+                            ctx = ctx
+                        )
                     # let user to resolve conflict by self
-                    Interrupt(reason = reason)
+                    Interrupt(reason = reason, ctx = ctx)
 
                 # preserve original committer information
                 ctx.plan_set_commiter_by_env()
                 ContinueCommitting(
                     path = self.path,
-                    commit_sha = self.commit_sha
+                    commit_sha = self.commit_sha,
+                    ctx = ctx
                 )
-                ResetCommitter()
+                ResetCommitter(ctx = ctx)
                 if ctx.cache_path:
-                    UpdateCache(path = self.path, commit_sha = c.sha)
+                    UpdateCache(path = self.path, commit_sha = c.sha,
+                        ctx = ctx
+                    )
                 return
 
-        self.git2("rev-parse", "HEAD")
-        c.cloned_sha = self._stdout.split(b"\n")[0]
+        c.cloned_sha = self.head_sha()
+
+    def pick_without_worktree(self):
+        """ Creates the copy of the commit using `git commit-tree`. If HEAD has
+same tree as the original parent then the original tree is used as is.
+Otherwise, the tree is computed by `git merge-tree --write-tree` (git 2.40 is
+required for `--merge-base`). Returns SHA1 of the commit or None if it must be
+created in the working tree.
+        """
+
+        ctx = self._ctx
+        sha = self.commit_sha
+
+        objects = ctx._cat_files
+
+        _, _, content = objects.read(self.path, sha)
+        # `git cat-file commit`
+        ctx._replaced += 1
+        header, message = content.split(b"\n\n", 1)
+
+        tree = None
+        parents = []
+        author = None
+        for line in header.split(b"\n"):
+            key, _, value = line.partition(b" ")
+            if key == b"tree":
+                tree = value
+            elif key == b"parent":
+                parents.append(value)
+            elif key == b"author":
+                author = value
+
+        if parents:
+            head = self.head_sha()
+            if head is None:
+                # current branch has no commits yet
+                return None
+
+            if (objects.sha(self.path, parents[0] + b"^{tree}")
+             != objects.sha(self.path, "HEAD^{tree}")
+            ):
+                if ctx._git_version < (2, 40, 0):
+                    return None
+
+                try:
+                    self.git2("merge-tree", "--write-tree",
+                        b"--merge-base=" + parents[0], head, sha
+                    )
+                except LaunchFailed:
+                    # conflicts
+                    return None
+
+                tree = self._stdout.split(b"\n")[0]
+
+            new_parents = [head]
+        else:
+            if self.head_sha() is not None:
+                return None
+
+            new_parents = []
+
+        # Author is preserved like `git cherry-pick` does. Committer is set
+        # by SetCommitter.
+        name, email, date = split_ident(author)
+        env = ctx.env
+        env["GIT_AUTHOR_NAME"] = name.decode("utf-8", "surrogateescape")
+        env["GIT_AUTHOR_EMAIL"] = email.decode("utf-8", "surrogateescape")
+        env["GIT_AUTHOR_DATE"] = date.decode("utf-8")
+
+        return self.commit_tree(tree, new_parents, message, env = env)
 
 class CreateHead(GitAction):
     __slots__ = ["name"]
@@ -845,6 +2003,24 @@ class CollectGarbage(GitAction):
     def __call__(self):
         self.git("gc", "--aggressive", "--prune=all")
 
+class FetchShard(GitAction):
+    """ Fetches references (full names) from a repository a part of the
+history was cloned to (see `plan_shards`). If `head` is set, its HEAD is
+checked out (detached).
+    """
+
+    __slots__ = ["address", "refs", "head"]
+
+    def __call__(self):
+        if self.refs:
+            self.git("fetch", "--no-tags", "--update-head-ok", self.address,
+                *[ "+%s:%s" % (r, r) for r in self.refs ]
+            )
+
+        if self.head:
+            self.git("fetch", "--no-tags", self.address, "HEAD")
+            self.git("checkout", "-f", "FETCH_HEAD")
+
 class PatchFileAction(GitAction):
     __slots__ = ["patch_name"]
 
@@ -852,13 +2028,16 @@ class ApplyPatchFile(PatchFileAction):
     def __call__(self):
         patch_name = self.patch_name
 
+        self._ctx.provide_worktree()
+
         try:
             self.git("am", "--committer-date-is-author-date", patch_name)
         except LaunchFailed:
             self.git("am", "--abort")
 
             Interrupt(
-                reason = "Failed to apply the patch form file '%s'" % patch_name
+                reason = "Failed to apply the patch form file '%s'" % patch_name,
+                ctx = self._ctx
             )
 
 class HEAD2PatchFile(PatchFileAction):
@@ -867,7 +2046,7 @@ class HEAD2PatchFile(PatchFileAction):
 
         self.git2("format-patch", "--stdout", "HEAD~1")
 
-        f = open(patch_name, "wb")
+        f = open(join(self.path, patch_name), "wb")
         f.write(self._stdout)
         f.close()
 
@@ -948,6 +2127,8 @@ class ApplyCache(GitAction):
 
         patch_file_name = cache[sha]
 
+        ctx.provide_worktree()
+
         print("Applying changes from " + patch_file_name)
 
         # analyze the patch and prepare working directory to patching
@@ -1010,17 +2191,18 @@ class ApplyCache(GitAction):
                 self.git("checkout", p_cloned_sha, cf)
 
         for f in created_files:
-            if isfile(f):
+            if isfile(join(self.path, f.decode("utf-8"))):
                 self.launch("rm", f)
 
         # actual patching
         try:
             out, err = launch(["patch", "-p", "1", "-i", patch_file_name],
-                epfx = "Failed to apply changes from '%s'" % patch_file_name
+                epfx = "Failed to apply changes from '%s'" % patch_file_name,
+                cwd = self.path
             )
         except LaunchFailed as e:
             out, err = e._stdout, e._stderr
-            Interrupt(reason = str(e))
+            Interrupt(reason = str(e), ctx = ctx)
 
         if out:
             self._out(out)
@@ -1028,7 +2210,7 @@ class ApplyCache(GitAction):
             self._err(err)
 
         # apply commit message
-        merge_msg_path = join(self.path, ".git", "MERGE_MSG")
+        merge_msg_path = join(self.git_dir(), "MERGE_MSG")
         if isfile(merge_msg_path):
             # a merge is in progress
             msg_f = open(merge_msg_path, "wb")
@@ -1055,4 +2237,46 @@ class ApplyCacheOrInterrupt(ApplyCache):
             ):
                 self.git("add", f)
         else:
-            Interrupt(reason = self.reason)
+            Interrupt(reason = self.reason, ctx = self._ctx)
+
+# Actions those set `cloned_sha` of the commit `commit_sha`.
+COMMITTING_ACTIONS = (CherryPick, MergeCloned, SubtreeMerge, ContinueCommitting)
+
+# Actions those are planned for interruptions and must be performed in the
+# working tree of the destination (see GitContext.do_parallel).
+SERIAL_ACTIONS = (Interrupt, ApplyCache, ContinueCommitting, UpdateCache)
+
+def split_segments(actions):
+    """ Splits @actions into (prologue, segments, tail). Each segment (a list)
+starts with a CheckoutCloned or CheckoutOrphan action. So, it does not depend
+on the state of the working tree. The prologue is actions before first
+segment. The tail is actions after last created commit (tags deletion,
+checkout of the original HEAD, etc.).
+    """
+
+    actions = list(actions)
+
+    last = -1
+    for i, a in enumerate(actions):
+        if isinstance(a, COMMITTING_ACTIONS + (ApplyPatchFile,)):
+            last = i
+
+    tail_start = len(actions)
+    for i in range(last + 1, len(actions)):
+        if not isinstance(actions[i], (ResetCommitter, ResetAuthor, CreateHead,
+            CreateTag, UpdateCache
+        )):
+            tail_start = i
+            break
+
+    prologue = []
+    segments = []
+    for a in actions[:tail_start]:
+        if isinstance(a, (CheckoutCloned, CheckoutOrphan)):
+            segments.append([a])
+        elif segments:
+            segments[-1].append(a)
+        else:
+            prologue.append(a)
+
+    return prologue, segments, actions[tail_start:]
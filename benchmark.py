@@ -0,0 +1,471 @@
+#!/usr/bin/python3
+
+""" Performance measurements for internals of Git Interactive Cloner. """
+
+from git import Repo
+from argparse import ArgumentParser
+from time import time
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import (
+    isdir,
+    join
+)
+import sys
+from common import (
+    CommitDesc,
+    CommitMetadata
+)
+from core import (
+    GICCommitDesc,
+    GICCompactGraph,
+    GitContext,
+    ProvideDirectory,
+    get_actual_parents,
+    order_commits,
+    count_checkouts,
+    load_context,
+    read_journal
+)
+
+def root_sets(sha2commit):
+    "Maps SHA1 of commits to sets of SHA1 of roots of their components."
+
+    comp2roots = {}
+    for c in sha2commit.values():
+        if not c.parents:
+            comp2roots.setdefault(c.root, set()).add(c.sha)
+
+    return dict((c.sha, comp2roots.get(c.root)) for c in sha2commit.values())
+
+def check_graph(sha2commit):
+    "Returns list of problems of numbering."
+
+    problems = []
+    for c in sha2commit.values():
+        if c.num is None:
+            problems.append("%s is not numbered" % c.sha)
+            continue
+        for p in c.parents:
+            if p.num is not None and p.num >= c.num:
+                problems.append("%s is numbered before its parent %s" % (
+                    c.sha, p.sha
+                ))
+    return problems
+
+def compare_graphs(a, b):
+    "Returns list of differences between two graphs."
+
+    if set(a) != set(b):
+        return ["Different commit sets (%d, %d)" % (len(a), len(b))]
+
+    diffs = []
+    a_roots, b_roots = root_sets(a), root_sets(b)
+
+    for sha, ac in a.items():
+        bc = b[sha]
+        if set(p.sha for p in ac.parents) != set(p.sha for p in bc.parents):
+            diffs.append("Parents of %s differ" % sha)
+        if set(c.sha for c in ac.children) != set(c.sha for c in bc.children):
+            diffs.append("Children of %s differ" % sha)
+        if set(h.path for h in ac.heads) != set(h.path for h in bc.heads):
+            diffs.append("Heads of %s differ" % sha)
+        if a_roots[sha] != b_roots[sha]:
+            diffs.append("Roots of %s differ" % sha)
+
+    return diffs
+
+def bench_graph(args):
+    repo = Repo(args.repository)
+
+    results = []
+
+    for name, build in [
+        ("GitPython walker", CommitDesc.build_git_graph),
+        ("git rev-list", CommitDesc.build_git_graph_rev_list),
+        ("commit-graph file", CommitDesc.build_git_graph_commit_graph)
+    ]:
+        best = None
+        for _ in range(args.repeat):
+            sha2commit = {}
+            stats = {}
+            t0 = time()
+            build(repo, sha2commit,
+                skip_remotes = True,
+                skip_stashes = True,
+                stats = stats
+            )
+            t = time() - t0
+            if best is None or t < best:
+                best = t
+
+        print("%-20s %8.3f sec, %d commits" % (name, best, len(sha2commit)))
+
+        for counter, value in sorted(stats.items()):
+            print("    %s: %d" % (counter, value))
+
+        for problem in check_graph(sha2commit):
+            print("    " + problem)
+
+        results.append((name, best, sha2commit))
+
+    _, walker_time, walker_graph = results[0]
+
+    ret = 0
+    for name, t, graph in results[1:]:
+        if t:
+            print("Speedup of %s: %.2f" % (name, walker_time / t))
+
+        diffs = compare_graphs(walker_graph, graph)
+        for d in diffs:
+            print("    " + d)
+        if diffs:
+            ret = 1
+
+    return ret
+
+def bench_memory(args):
+    import tracemalloc
+
+    repo = Repo(args.repository)
+
+    def build_dict():
+        sha2commit = {}
+        GICCommitDesc.build_git_graph_rev_list(repo, sha2commit,
+            skip_remotes = True,
+            skip_stashes = True
+        )
+        return sha2commit
+
+    def build_compact():
+        graph = GICCompactGraph()
+        graph.build_git_graph(repo, skip_remotes = True, skip_stashes = True)
+        return graph
+
+    results = []
+
+    for name, build in [
+        ("GICCommitDesc dict", build_dict),
+        ("GICCompactGraph", build_compact)
+    ]:
+        tracemalloc.start()
+        t0 = time()
+        graph = build()
+        t = time() - t0
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Note that time is affected by tracing.
+        print("%-20s %8.3f sec, %10d bytes (%6.1f per commit), peak %d" % (
+            name, t, current, float(current) / max(len(graph), 1), peak
+        ))
+
+        results.append(current)
+        del graph
+
+    if results[1]:
+        print("Reduction: %.2f" % (float(results[0]) / results[1]))
+
+def synthetic_skip_chains(runs, length, merges):
+    """ Builds a synthetic history for get_actual_parents. The main stream
+consists of @runs runs of @length skipped commits, each run follows one copied
+commit. Each run is also merged by @merges side commits at evenly spaced
+positions. Returns `sha2commit`, `metadata` and a list of lookups `plan` would
+perform: one per parent of every copied commit.
+    """
+
+    sha2commit = {}
+    metadata = {}
+    queries = []
+
+    def add(parents, skipped):
+        sha = "%040x" % len(sha2commit)
+        c = GICCommitDesc(sha, [], [])
+        c.skipped = skipped
+        sha2commit[sha] = c
+        m = CommitMetadata()
+        m.sha = sha
+        m.parents = parents
+        metadata[sha] = m
+        if not skipped:
+            queries.extend(parents)
+        return sha
+
+    prev = add([], False)
+    for _ in range(runs):
+        run = []
+        for _ in range(length):
+            prev = add([prev], True)
+            run.append(prev)
+
+        for i in range(merges):
+            add([prev, run[(i * length) // merges]], False)
+
+        prev = add([prev], False)
+
+    return sha2commit, metadata, queries
+
+def bench_skips(args):
+    sha2commit, metadata, queries = synthetic_skip_chains(args.runs,
+        args.length, args.merges
+    )
+
+    print("%d commits, %d lookups" % (len(sha2commit), len(queries)))
+
+    results = []
+
+    for name, make_memo in [
+        ("without memo", lambda : None),
+        ("memoized", dict)
+    ]:
+        best = None
+        for _ in range(args.repeat):
+            memo = make_memo()
+            t0 = time()
+            res = [
+                get_actual_parents(sha, sha2commit, metadata, memo = memo)
+                    for sha in queries
+            ]
+            t = time() - t0
+            if best is None or t < best:
+                best = t
+
+        print("%-20s %8.3f sec" % (name, best))
+
+        results.append((best, res))
+
+    (base_time, base_res), (memo_time, memo_res) = results
+
+    if memo_time:
+        print("Speedup: %.2f" % (base_time / memo_time))
+
+    if base_res != memo_res:
+        print("    Replacements differ")
+        return 1
+
+    return 0
+
+def synthetic_interleaved(commits, branches, seed):
+    """ Builds a synthetic history of @commits commits where up to @branches
+branches grow in parallel, fork and merge randomly (by @seed). Commits are
+listed in creation order like commit dates would order them. Returns the list
+and a mapping of first parents (see order_commits).
+    """
+
+    rnd = Random(seed)
+
+    def add(parents):
+        c = GICCommitDesc("%040x" % len(queue), parents, [])
+        for p in parents:
+            p.children.append(c)
+        queue.append(c)
+        return c
+
+    queue = []
+    heads = [add([])]
+
+    for _ in range(commits - 1):
+        r = rnd.random()
+        if r < 0.05 and len(heads) < branches:
+            heads.append(add([rnd.choice(heads)]))
+        elif r < 0.08 and len(heads) > 1:
+            a, b = rnd.sample(range(len(heads)), 2)
+            heads[a] = add([heads[a], heads[b]])
+            del heads[b]
+        else:
+            i = rnd.randrange(len(heads))
+            heads[i] = add([heads[i]])
+
+    first_parents = dict(
+        (c.sha, c.parents[0].sha if c.parents else None) for c in queue
+    )
+
+    return queue, first_parents
+
+def bench_order(args):
+    queue, first_parents = synthetic_interleaved(args.commits, args.branches,
+        args.seed
+    )
+
+    t0 = time()
+    order = order_commits(queue, first_parents)
+    t = time() - t0
+
+    position = dict((c.sha, i) for i, c in enumerate(order))
+    for c in queue:
+        for p in c.parents:
+            if position[p.sha] >= position[c.sha]:
+                print("    Order is not topological")
+                return 1
+
+    print("%d commits, ordered in %.3f sec" % (len(queue), t))
+    print("Checkouts in creation order: %d" % count_checkouts(queue,
+        first_parents
+    ))
+    print("Checkouts in optimized order: %d" % count_checkouts(order,
+        first_parents
+    ))
+
+    return 0
+
+def bench_journal(args):
+    """ Kills (abandons) a journaled context of directory creations after
+each of first @args.kills actions and continues it the way `gic.py` does: the
+snapshot is loaded and the journal is replayed.
+    """
+
+    ret = 0
+    tmp = mkdtemp()
+    try:
+        state_file = join(tmp, "state.py")
+        journal_file = join(tmp, "state.journal")
+
+        for killed_after in range(args.kills + 1):
+            work = join(tmp, "work%d" % killed_after)
+
+            ctx = GitContext(src_repo_path = tmp,
+                cache_path = join(tmp, "cache")
+            )
+            for i in range(args.actions):
+                ProvideDirectory(path = join(work, str(i)), ctx = ctx)
+
+            ctx.open_journal(state_file, journal_file)
+            t0 = time()
+            ctx.do(limit = killed_after)
+            t = time() - t0
+            # The process is killed here: nothing is saved.
+
+            loaded = load_context(state_file)
+            loaded.replay(read_journal(journal_file))
+
+            print("Killed after %d actions (%.3f sec)" % (killed_after, t))
+            if loaded.current_action < 0:
+                print("    The snapshot is not started, the clone would be "
+                    "planned again"
+                )
+                ret = 1
+            if loaded.current_action != killed_after:
+                print("    %d actions are done after replaying" % (
+                    loaded.current_action
+                ))
+                ret = 1
+            if len(loaded.actions) != args.actions:
+                print("    %d actions are loaded, %d expected" % (
+                    len(loaded.actions), args.actions
+                ))
+                ret = 1
+
+            loaded.open_journal(state_file, journal_file)
+            if not loaded.do():
+                print("    Continuation failed")
+                ret = 1
+            loaded.close_journal()
+
+            if not loaded.finished or not all(
+                isdir(join(work, str(i))) for i in range(args.actions)
+            ):
+                print("    The continuation is not finished")
+                ret = 1
+    finally:
+        rmtree(tmp)
+
+    return ret
+
+def main():
+    ap = ArgumentParser(
+        description = "Benchmarks for Git Interactive Cloner internals."
+    )
+    sp = ap.add_subparsers(dest = "benchmark")
+
+    graph = sp.add_parser("graph",
+        help = "Compare graph building backends on a repository."
+    )
+    graph.add_argument("repository")
+    graph.add_argument("-r", "--repeat",
+        type = int,
+        default = 1,
+        help = "Take best time of several runs."
+    )
+    graph.set_defaults(func = bench_graph)
+
+    memory = sp.add_parser("memory",
+        help = "Compare memory used by graph representations."
+    )
+    memory.add_argument("repository")
+    memory.set_defaults(func = bench_memory)
+
+    skips = sp.add_parser("skips",
+        help = "Measure skipped parent substitution on a synthetic history "
+            "with long runs of skipped commits."
+    )
+    skips.add_argument("-n", "--runs",
+        type = int,
+        default = 10,
+        help = "Number of runs of skipped commits."
+    )
+    skips.add_argument("-l", "--length",
+        type = int,
+        default = 2000,
+        help = "Number of commits in a run."
+    )
+    skips.add_argument("-m", "--merges",
+        type = int,
+        default = 100,
+        help = "Number of merges of commits of a run."
+    )
+    skips.add_argument("-r", "--repeat",
+        type = int,
+        default = 1,
+        help = "Take best time of several runs."
+    )
+    skips.set_defaults(func = bench_skips)
+
+    order = sp.add_parser("order",
+        help = "Count checkouts the commit order optimizer avoids on a "
+            "synthetic history with interleaved branches."
+    )
+    order.add_argument("-n", "--commits",
+        type = int,
+        default = 100000,
+        help = "Number of commits."
+    )
+    order.add_argument("-b", "--branches",
+        type = int,
+        default = 30,
+        help = "Maximum number of branches growing in parallel."
+    )
+    order.add_argument("-s", "--seed",
+        type = int,
+        default = 1,
+        help = "Seed of the random history."
+    )
+    order.set_defaults(func = bench_order)
+
+    journal = sp.add_parser("journal",
+        help = "Check that a cloning killed after its first actions is "
+            "continued from the snapshot and the journal."
+    )
+    journal.add_argument("-n", "--actions",
+        type = int,
+        default = 100,
+        help = "Number of actions."
+    )
+    journal.add_argument("-k", "--kills",
+        type = int,
+        default = 3,
+        help = "Kill after 0, 1, ... KILLS actions."
+    )
+    journal.set_defaults(func = bench_journal)
+
+    args = ap.parse_args()
+
+    if args.benchmark is None:
+        ap.print_help(sys.stdout)
+        return 1
+
+    return args.func(args)
+
+if __name__ == "__main__":
+    ret = main()
+    exit(0 if ret is None else ret)
@@ -1,9 +1,13 @@
 from .antiset import *
 from .argparse_tools import *
 from .git_tools import *
+from .graph_progress import *
+from .journal import *
+from .compact_graph import *
 from .co_dispatcher import *
 from .launch import *
 from .pygen import *
 from .reflection import *
+from .roots import *
 from .sloted import *
 from .topology import *
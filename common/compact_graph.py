@@ -0,0 +1,427 @@
+__all__ = [
+    "CompactGraph"
+  , "CompactCommit"
+  , "compact_flag"
+  , "compact_attribute"
+]
+
+from .git_tools import (
+    GGB_IBY,
+    iter_rev_list,
+    get_ref_tips,
+    select_ref_tips
+)
+from .co_dispatcher import callco
+from .roots import RootIndex
+from array import array
+from binascii import (
+    hexlify,
+    unhexlify
+)
+from bisect import bisect_left
+from git.refs import Reference
+
+class CompactCommit(object):
+    """ A view of a commit in a CompactGraph. It provides same attributes as
+CommitDesc does. Views are created on demand and are not cached. So, compare
+them using == rather than `is`.
+    """
+
+    __slots__ = ["_graph", "_id"]
+
+    def __init__(self, graph, _id):
+        self._graph = graph
+        self._id = _id
+
+    @property
+    def sha(self):
+        i = self._id * 20
+        return hexlify(self._graph._shas[i:i + 20]).decode("ascii")
+
+    @property
+    def parents(self):
+        g = self._graph
+        i = self._id
+        ps = g._parent_start
+        return [ g._view(p) for p in g._parent_ids[ps[i]:ps[i + 1]] ]
+
+    @property
+    def children(self):
+        g = self._graph
+        i = self._id
+        cs = g._child_start
+        return [ g._view(c) for c in g._child_ids[cs[i]:cs[i + 1]] ]
+
+    @property
+    def num(self):
+        return self._graph._num[self._id]
+
+    @property
+    def root(self):
+        r = self._graph._root[self._id]
+        return None if r < 0 else r
+
+    @property
+    def heads(self):
+        return self._graph._heads.get(self._id, [])
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactCommit)
+            and self._id == other._id
+            and self._graph is other._graph
+        )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._id
+
+def compact_flag(name):
+    """ Defines a property of CompactCommit subclass backed by the
+`bytearray` of the graph which is listed in `flags` of the graph class.
+    """
+
+    attr = "_flag_" + name
+
+    def getter(self):
+        return bool(getattr(self._graph, attr)[self._id])
+
+    def setter(self, value):
+        getattr(self._graph, attr)[self._id] = 1 if value else 0
+
+    return property(getter, setter)
+
+def compact_attribute(name):
+    """ Defines a property of CompactCommit subclass backed by a sparse `dict`
+of the graph which is listed in `attributes` of the graph class. The default
+value is None.
+    """
+
+    attr = "_attr_" + name
+
+    def getter(self):
+        return getattr(self._graph, attr).get(self._id, None)
+
+    def setter(self, value):
+        values = getattr(self._graph, attr)
+        if value is None:
+            values.pop(self._id, None)
+        else:
+            values[self._id] = value
+
+    return property(getter, setter)
+
+class _ShaColumn(object):
+    "Sequence interface for `bisect` over the binary SHA1 column."
+
+    __slots__ = ["shas"]
+
+    def __init__(self, shas):
+        self.shas = shas
+
+    def __getitem__(self, i):
+        i *= 20
+        return self.shas[i:i + 20]
+
+    def __len__(self):
+        return len(self.shas) // 20
+
+class _NumOrder(object):
+    __slots__ = ["graph"]
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __iter__(self):
+        view = self.graph._view
+        for i in self.graph._by_num:
+            yield view(i)
+
+    def __getitem__(self, i):
+        graph = self.graph
+        return graph._view(graph._by_num[i])
+
+    def __len__(self):
+        return len(self.graph._by_num)
+
+class CompactGraph(object):
+    """ Commit graph stored in typed arrays. It uses much less memory than a
+dict of CommitDesc. Each commit is identified by a dense integer id which is
+the index of its SHA1 in the sorted SHA1 column. Parents and children are
+kept in compressed sparse row (CSR) form: ids of parents of commit `i` are
+`_parent_ids[_parent_start[i]:_parent_start[i + 1]]`.
+
+The graph behaves as a mapping from SHA1 to commit views. So, it can be given
+instead of the dict filled by CommitDesc.build_git_graph.
+
+Subclasses may define extra per-commit boolean `flags` and object
+`attributes` and corresponding `commit_type` properties. See compact_flag and
+compact_attribute.
+    """
+
+    commit_type = CompactCommit
+    flags = ()
+    attributes = ()
+
+    def __init__(self):
+        self._shas = b""
+        self._num = array("i")
+        # component ids, see RootIndex
+        self._root = array("i")
+        self._parent_start = array("I", [0])
+        self._parent_ids = array("I")
+        self._child_start = array("I", [0])
+        self._child_ids = array("I")
+        self._heads = {}
+        # commit ids in topological order
+        self._by_num = array("I")
+
+        self._reset_extra(0)
+
+    def _reset_extra(self, count):
+        for name in self.flags:
+            setattr(self, "_flag_" + name, bytearray(count))
+        for name in self.attributes:
+            setattr(self, "_attr_" + name, {})
+
+    def _view(self, _id):
+        return self.commit_type(self, _id)
+
+    def id_of(self, sha):
+        "Returns id of the commit or -1."
+
+        key = unhexlify(sha)
+        shas = self._shas
+        col = _ShaColumn(shas)
+        i = bisect_left(col, key)
+        if i < len(col) and col[i] == key:
+            return i
+        return -1
+
+    def __getitem__(self, sha):
+        i = self.id_of(sha)
+        if i < 0:
+            raise KeyError(sha)
+        return self._view(i)
+
+    def get(self, sha, default = None):
+        i = self.id_of(sha)
+        if i < 0:
+            return default
+        return self._view(i)
+
+    def __contains__(self, sha):
+        return self.id_of(sha) >= 0
+
+    def __len__(self):
+        return len(self._num)
+
+    def __iter__(self):
+        shas = self._shas
+        for i in range(0, len(shas), 20):
+            yield hexlify(shas[i:i + 20]).decode("ascii")
+
+    keys = __iter__
+
+    def values(self):
+        view = self._view
+        return (view(i) for i in range(len(self._num)))
+
+    def items(self):
+        view = self._view
+        return ((c.sha, c) for c in (view(i) for i in range(len(self._num))))
+
+    def by_num(self):
+        """ Returns commits in topological order (by `num`) as an iterable
+which can be iterated several times.
+        """
+        return _NumOrder(self)
+
+    def co_build_git_graph(self, repo,
+        skip_remotes = False,
+        skip_stashes = False,
+        refs = None,
+        git_command = "git",
+        tips = None,
+        stats = None
+    ):
+        """ Fills the graph using one `git rev-list` process. Arguments have
+same meaning as for CommitDesc.co_build_git_graph_rev_list. The graph is empty
+until the end. So, "commits" counter is also updated in @stats.
+        """
+
+        if tips is None:
+            tips = get_ref_tips(repo.working_dir, git_command = git_command)
+
+        selected = select_ref_tips(tips,
+            skip_remotes = skip_remotes,
+            skip_stashes = skip_stashes,
+            refs = refs
+        )
+
+        revs = list(selected.values())
+        if revs:
+            lines = iter_rev_list(repo.working_dir, revs,
+                git_command = git_command,
+                idle = True
+            )
+        else:
+            lines = []
+
+        yield self.co_build_from_lines(lines, stats = stats)
+
+        # heads
+        for path, sha in tips.items():
+            i = self.id_of(sha)
+            if i < 0:
+                continue
+            self._heads.setdefault(i, []).append(
+                Reference.from_path(repo, path)
+            )
+
+    def build_git_graph(self, *args, **kw):
+        """ Wrapper for co_build_git_graph """
+        callco(self.co_build_git_graph(*args, **kw))
+
+    def co_build_from_lines(self, lines, stats = None):
+        """ Fills the graph from (sha, parent_shas) tuples listed in reversed
+topological order (children first) like `git rev-list --topo-order` does.
+None in @lines means that nothing is listed yet (see iter_rev_list).
+"commits" and "edges" counters are updated in @stats.
+        """
+
+        # iterations to yield
+        i2y = GGB_IBY
+
+        # Columns in stream order. SHA1 are kept binary.
+        stream_shas = []
+        stream_parent_counts = array("I")
+        stream_parent_shas = []
+
+        for entry in lines:
+            if entry is None:
+                yield False
+                continue
+
+            sha, parent_shas = entry
+            stream_shas.append(unhexlify(sha))
+            stream_parent_counts.append(len(parent_shas))
+            stream_parent_shas.extend(unhexlify(p) for p in parent_shas)
+
+            if i2y <= 0:
+                if stats is not None:
+                    stats["commits"] = len(stream_shas)
+                    stats["edges"] = len(stream_parent_shas)
+                yield True
+                i2y = GGB_IBY
+            else:
+                i2y -= 1
+
+        count = len(stream_shas)
+
+        if stats is not None:
+            stats["commits"] = count
+            stats["edges"] = len(stream_parent_shas)
+
+        # Commit id is the index in the sorted SHA1 column.
+        order = sorted(range(count), key = stream_shas.__getitem__)
+        self._shas = b"".join(stream_shas[k] for k in order)
+
+        sha2id = dict((stream_shas[k], i) for i, k in enumerate(order))
+        del stream_shas
+
+        yield True
+
+        # Parents of each commit are stored in id order.
+        parent_start = array("I", [0]) * (count + 1)
+        for i, k in enumerate(order):
+            parent_start[i + 1] = stream_parent_counts[k]
+        for i in range(count):
+            parent_start[i + 1] += parent_start[i]
+
+        stream_parent_start = array("I", [0]) * (count + 1)
+        for k in range(count):
+            stream_parent_start[k + 1] = (stream_parent_start[k]
+                + stream_parent_counts[k]
+            )
+        del stream_parent_counts
+
+        edges = len(stream_parent_shas)
+        parent_ids = array("I", [0]) * edges
+        child_counts = array("I", [0]) * (count + 1)
+        for i, k in enumerate(order):
+            pi = parent_start[i]
+            for e in range(stream_parent_start[k], stream_parent_start[k + 1]):
+                p = sha2id[stream_parent_shas[e]]
+                parent_ids[pi] = p
+                pi += 1
+                child_counts[p + 1] += 1
+
+            if i2y <= 0:
+                yield True
+                i2y = GGB_IBY
+            else:
+                i2y -= 1
+
+        del stream_parent_shas
+        del sha2id
+
+        # children (CSR transposition)
+        child_start = child_counts
+        for i in range(count):
+            child_start[i + 1] += child_start[i]
+
+        child_fill = array("I", child_start)
+        child_ids = array("I", [0]) * edges
+        for i in range(count):
+            for p in parent_ids[parent_start[i]:parent_start[i + 1]]:
+                child_ids[child_fill[p]] = i
+                child_fill[p] += 1
+        del child_fill
+
+        # Topological numbering is reversed stream order.
+        by_num = array("I", [0]) * count
+        for i, k in enumerate(order):
+            by_num[count - 1 - k] = i
+        del order
+
+        num = array("i", [0]) * count
+        for n, i in enumerate(by_num):
+            num[i] = n
+
+        root_index = RootIndex()
+        union = root_index.union
+        root = array("i", [0]) * count
+        for i in by_num:
+            ps = parent_ids[parent_start[i]:parent_start[i + 1]]
+            if ps:
+                r = root[ps[0]]
+                for p in ps[1:]:
+                    r = union(r, root[p])
+            else:
+                r = root_index.add_root(
+                    hexlify(self._shas[i * 20:(i + 1) * 20]).decode("ascii")
+                )
+            root[i] = r
+
+            if i2y <= 0:
+                yield True
+                i2y = GGB_IBY
+            else:
+                i2y -= 1
+
+        find = root_index.find
+        for i in range(count):
+            root[i] = find(root[i])
+
+        self._num = num
+        self._by_num = by_num
+        self._root = root
+        self._parent_start = parent_start
+        self._parent_ids = parent_ids
+        self._child_start = child_start
+        self._child_ids = child_ids
+        self._heads = {}
+
+        self._reset_extra(count)
@@ -1,14 +1,390 @@
 __all__ = [
     "GGB_IBY",
-    "CommitDesc"
+    "CommitDesc",
+    "iter_rev_list",
+    "CommitMetadata",
+    "iter_commit_metadata",
+    "read_commit_metadata",
+    "CommitGraphFile",
+    "open_commit_graph",
+    "CatFile",
+    "CatFilePool",
+    "RefReader",
+    "RefSnapshot",
+    "get_ref_tips",
+    "select_ref_tips"
 ]
 
 from .antiset import antiset
 from .co_dispatcher import callco
+from .roots import RootIndex
+from .launch import (
+    launch,
+    LaunchFailed
+)
+from subprocess import (
+    Popen,
+    PIPE
+)
+from array import array
+from binascii import (
+    hexlify,
+    unhexlify
+)
+from collections import OrderedDict
+from struct import (
+    pack,
+    unpack_from
+)
+from os import (
+    read,
+    stat,
+    rename,
+    unlink
+)
+from os.path import (
+    isabs,
+    isdir,
+    isfile,
+    join
+)
+from mmap import (
+    mmap,
+    ACCESS_READ
+)
+from git.refs import Reference
+from select import select
+import sys
 
 # Iterations Between Yields of Git Graph Building task
 GGB_IBY = 100
 
+# Seconds `git rev-list` may print nothing before iter_rev_list yields None.
+REV_LIST_IDLE = 0.01
+
+def iter_rev_list(repo_path, revs,
+    git_command = "git",
+    options = ("--topo-order",),
+    idle = False
+):
+    """ Streams output of `git rev-list --parents` launched in @repo_path.
+Yields a tuple (sha, parent_shas) per commit. Revisions are passed through
+standard input to avoid command line length limit on big reference lists.
+
+If @idle, None is yielded while git prints nothing. So, a coroutine reading
+the stream can give control to other tasks (`--topo-order` prints nothing
+until the whole history is walked). Pipes cannot be polled on Windows. So,
+the stream is read the usual way there.
+    """
+
+    p = Popen(
+        [git_command, "rev-list", "--parents"] + list(options) + ["--stdin"],
+        cwd = repo_path,
+        stdin = PIPE,
+        stdout = PIPE,
+        stderr = PIPE
+    )
+
+    # `git rev-list` reads whole standard input before walking. So, there is
+    # no risk of dead lock.
+    p.stdin.write("".join(rev + "\n" for rev in revs).encode("utf-8"))
+    p.stdin.close()
+
+    if idle and sys.platform != "win32":
+        fd = p.stdout.fileno()
+        tail = b""
+        while True:
+            if not select([fd], [], [], REV_LIST_IDLE)[0]:
+                yield None
+                continue
+
+            chunk = read(fd, 1 << 16)
+            if not chunk:
+                break
+
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                shas = line.decode("ascii").split()
+                yield shas[0], shas[1:]
+    else:
+        for line in p.stdout:
+            shas = line.decode("ascii").split()
+            yield shas[0], shas[1:]
+
+    p.stdout.close()
+    _stderr = p.stderr.read()
+    p.stderr.close()
+
+    returncode = p.wait()
+    if returncode:
+        raise LaunchFailed(returncode, b"", _stderr,
+            "Launch of git rev-list in '%s' has failed\n  stderr:\\\n%sEoF\n"
+            % (repo_path, _stderr.decode("utf-8", "replace"))
+        )
+
+class CommitMetadata(object):
+    """ Fields of a commit those are needed for planning. Dates are seconds
+since epoch. Time zone offsets are in seconds west of UTC like GitPython
+`author_tz_offset` is. `parents` is list of SHA1 in original order.
+    """
+
+    __slots__ = [
+        "sha",
+        "parents",
+        "author_name",
+        "author_email",
+        "authored_date",
+        "author_tz_offset",
+        "committer_name",
+        "committer_email",
+        "committed_date",
+        "committer_tz_offset",
+        "message"
+    ]
+
+# Fields of `git log` output for CommitMetadata, separated by NUL. Dates are
+# "seconds +HHMM".
+COMMIT_METADATA_FORMAT = "%x00".join([
+    "%H", "%P", "%an", "%ae", "%ad", "%cn", "%ce", "%cd", "%B"
+])
+COMMIT_METADATA_FIELDS = 9
+
+def parse_raw_date(raw):
+    "Converts `git log --date=raw` date to (seconds, offset west of UTC)."
+
+    seconds, tz = raw.split(" ")
+    offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+    if tz[0] != "-":
+        offset = -offset
+    return int(seconds), offset
+
+def iter_commit_metadata(repo_path, shas, git_command = "git"):
+    """ Streams CommitMetadata of commits @shas (in that order) from one
+`git log --no-walk` process launched in @repo_path.
+    """
+
+    p = Popen(
+        [git_command, "log", "--no-walk=unsorted", "--stdin", "-z",
+            "--date=raw", "--format=" + COMMIT_METADATA_FORMAT
+        ],
+        cwd = repo_path,
+        stdin = PIPE,
+        stdout = PIPE,
+        stderr = PIPE
+    )
+
+    # As `git rev-list`, `git log` reads whole standard input first.
+    p.stdin.write("".join(sha + "\n" for sha in shas).encode("utf-8"))
+    p.stdin.close()
+
+    # Each field (including the last one of a commit) is terminated by NUL.
+    fields = []
+    rest = b""
+    while True:
+        chunk = p.stdout.read(1 << 16)
+        if not chunk:
+            break
+
+        tokens = (rest + chunk).split(b"\0")
+        rest = tokens.pop()
+
+        for t in tokens:
+            fields.append(t)
+            if len(fields) < COMMIT_METADATA_FIELDS:
+                continue
+
+            (sha, parents, an, ae, ad, cn, ce, cd, message) = (
+                f.decode("utf-8", "replace") for f in fields
+            )
+            del fields[:]
+
+            m = CommitMetadata()
+            m.sha = sha
+            m.parents = parents.split()
+            m.author_name = an
+            m.author_email = ae
+            m.authored_date, m.author_tz_offset = parse_raw_date(ad)
+            m.committer_name = cn
+            m.committer_email = ce
+            m.committed_date, m.committer_tz_offset = parse_raw_date(cd)
+            m.message = message
+            yield m
+
+    p.stdout.close()
+    _stderr = p.stderr.read()
+    p.stderr.close()
+
+    returncode = p.wait()
+    if returncode:
+        raise LaunchFailed(returncode, b"", _stderr,
+            "Launch of git log in '%s' has failed\n  stderr:\\\n%sEoF\n"
+            % (repo_path, _stderr.decode("utf-8", "replace"))
+        )
+
+def read_commit_metadata(repo_path, shas, git_command = "git"):
+    "Returns a dict mapping SHA1 to CommitMetadata. See iter_commit_metadata."
+
+    return dict((m.sha, m) for m in iter_commit_metadata(repo_path, shas,
+        git_command = git_command
+    ))
+
+# Special values of parent positions in CDAT chunk of a commit-graph file
+COMMIT_GRAPH_NO_PARENT = 0x70000000
+COMMIT_GRAPH_EXTRA_EDGES = 0x80000000
+
+class CommitGraphFile(object):
+    """ Reader of a git commit-graph file (`objects/info/commit-graph`). The
+file is mapped to memory and is never copied. Commits are identified by their
+positions in the file. When the file is a layer of a split commit-graph chain,
+positions of its commits follow positions of commits of @base layers.
+    """
+
+    def __init__(self, file_name, base = None):
+        f = open(file_name, "rb")
+        try:
+            data = mmap(f.fileno(), 0, access = ACCESS_READ)
+        finally:
+            f.close()
+
+        self.data = data
+        self.base = base
+
+        if data[:4] != b"CGPH":
+            raise ValueError("Not a commit-graph file: " + file_name)
+
+        version, hash_version, chunks_count = unpack_from(">BBB", data, 4)
+        if version != 1:
+            raise ValueError("Unsupported commit-graph version %d" % version)
+        if hash_version != 1:
+            raise ValueError("Only SHA1 commit-graph files are supported")
+
+        chunks = {}
+        for i in range(chunks_count):
+            chunk_id, offset = unpack_from(">4sQ", data, 8 + 12 * i)
+            chunks[chunk_id] = offset
+
+        self.fanout = chunks[b"OIDF"]
+        self.oids = chunks[b"OIDL"]
+        self.cdat = chunks[b"CDAT"]
+        self.edges = chunks.get(b"EDGE", None)
+
+        self.count, = unpack_from(">L", data, self.fanout + 255 * 4)
+        self.offset = 0 if base is None else (base.offset + base.count)
+
+    def close(self):
+        self.data.close()
+        if self.base is not None:
+            self.base.close()
+
+    def __len__(self):
+        "Total number of commits including base layers."
+        return self.offset + self.count
+
+    def _layer(self, pos):
+        layer = self
+        while pos < layer.offset:
+            layer = layer.base
+        return layer
+
+    def position(self, sha):
+        "Returns position of the commit or -1 if the file does not cover it."
+
+        key = unhexlify(sha)
+        data = self.data
+        oids = self.oids
+
+        first = bytearray(key[:1])[0]
+        if first:
+            lo, = unpack_from(">L", data, self.fanout + (first - 1) * 4)
+        else:
+            lo = 0
+        hi, = unpack_from(">L", data, self.fanout + first * 4)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            o = oids + mid * 20
+            mid_key = data[o:o + 20]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self.offset + mid
+
+        if self.base is None:
+            return -1
+        return self.base.position(sha)
+
+    def sha(self, pos):
+        layer = self._layer(pos)
+        o = layer.oids + (pos - layer.offset) * 20
+        return hexlify(layer.data[o:o + 20]).decode("ascii")
+
+    def parents(self, pos):
+        "Returns list of positions of parents in original order."
+
+        layer = self._layer(pos)
+        data = layer.data
+        p1, p2 = unpack_from(">LL", data,
+            layer.cdat + (pos - layer.offset) * 36 + 20
+        )
+
+        if p1 == COMMIT_GRAPH_NO_PARENT:
+            return []
+        if p2 == COMMIT_GRAPH_NO_PARENT:
+            return [p1]
+        if not p2 & COMMIT_GRAPH_EXTRA_EDGES:
+            return [p1, p2]
+
+        # an octopus merge, other parents are listed in EDGE chunk
+        ret = [p1]
+        o = layer.edges + (p2 & ~COMMIT_GRAPH_EXTRA_EDGES) * 4
+        while True:
+            p, = unpack_from(">L", data, o)
+            ret.append(p & ~COMMIT_GRAPH_EXTRA_EDGES)
+            if p & COMMIT_GRAPH_EXTRA_EDGES:
+                break
+            o += 4
+        return ret
+
+def open_commit_graph(git_dir):
+    """ Opens commit-graph file(s) of a repository. Returns a CommitGraphFile
+(the top layer of a chain) or None if there is no file or git would not use
+it (grafts or a shallow clone).
+    """
+
+    if isfile(join(git_dir, "shallow")) \
+    or isfile(join(git_dir, "info", "grafts")):
+        return None
+
+    info = join(git_dir, "objects", "info")
+
+    chain_file = join(info, "commit-graphs", "commit-graph-chain")
+    if isfile(chain_file):
+        f = open(chain_file, "r")
+        hashes = f.read().split()
+        f.close()
+
+        graph = None
+        try:
+            for h in hashes:
+                graph = CommitGraphFile(
+                    join(info, "commit-graphs", "graph-%s.graph" % h),
+                    base = graph
+                )
+        except:
+            if graph is not None:
+                graph.close()
+            raise
+        return graph
+
+    file_name = join(info, "commit-graph")
+    if isfile(file_name):
+        return CommitGraphFile(file_name)
+
+    return None
+
 class CommitDesc(object):
     def __init__(self, sha, parents, children):
         self.sha = sha
@@ -18,14 +394,18 @@ class CommitDesc(object):
 
         # serial number according to the topological sorting
         self.num = None
-        # roots bit mask
-        self.roots = 0
+        # Id of the component of the history (see RootIndex). Commits have
+        # same `root` if and only if they are connected by ancestry.
+        self.root = None
 
     @classmethod
     def co_build_git_graph(klass, repo, commit_desc_nodes,
         skip_remotes = False,
         skip_stashes = False,
-        refs = None
+        refs = None,
+        git_command = "git",
+        stats = None,
+        tips = None
     ):
         """
 Builds a graph of repo. Any commit is given a descriptor of type either
@@ -51,13 +431,34 @@ refs:
 
     If None is given then ancestors of all references will be taken into
     account.
+
+git_command:
+    The git executable to list references by if @tips is not given.
+
+stats:
+    A dict to put counters into. "arity_checks" is the number of parent count
+    checks performed during topological sorting. "edges" and "stack_depth"
+    (the number of edges visited and pending) are updated during building. So,
+    the progress can be watched by another coroutine (see GraphBuildProgress).
+
+tips:
+    A RefSnapshot of @repo (see get_ref_tips). It is read if not given.
         """
 
-        refs = antiset() if refs is None else set(refs)
+        if tips is None:
+            tips = get_ref_tips(repo.working_dir, git_command = git_command)
+
+        selected = select_ref_tips(tips,
+            skip_remotes = skip_remotes,
+            skip_stashes = skip_stashes,
+            refs = refs
+        )
 
         # iterations to yield
         i2y = GGB_IBY
 
+        edges = 0
+
         # n is serial number according to the topology sorting
         n = 0
         # to_enum is used during topological sorting
@@ -67,38 +468,38 @@ refs:
         # (parent, child), where parent is instance of
         # git.Commit, child is instance of CommitDesc
         build_stack = []
-        # Each history root is represented by a bit in CommitDesc.roots of each
-        # commit. root_bit is value for next found root.
-        root_bit = 1
+        # Components of the history are tracked by union-find. A commit joins
+        # components of its parents when it is enumerated.
+        root_index = RootIndex()
+        # Number of parents of each added commit which is not enumerated yet.
+        # It is filled when the parents are got for the first time. So, the
+        # topological sorting does not look commits up in the repository.
+        parent_counts = {}
+        arity_checks = 0
 
-        for head in repo.references:
-            if skip_remotes and head.path.startswith("refs/remotes/"):
-                continue
-            if skip_stashes and head.path.startswith("refs/stash"):
-                continue
-
-            if head.path in refs:
-                refs.remove(head.path) # unknown reference detection
-            else:
-                continue
-
-            hcommit = head.commit
-            hsha = hcommit.hexsha
-
-            try:
-                head_desc = commit_desc_nodes[hsha]
-            except KeyError:
-                head_desc = klass(hsha, [], [])
-            else:
+        for hsha in selected.values():
+            if hsha in commit_desc_nodes:
                 continue
 
+            hcommit = repo.commit(hsha)
+            head_desc = klass(hsha, [], [])
             commit_desc_nodes[hsha] = head_desc
+            hparents = hcommit.parents
+            parent_counts[hsha] = len(hparents)
             # add edges connected to head being processed
-            for p in hcommit.parents:
+            for p in hparents:
                 build_stack.append((p, head_desc))
 
+            if not hparents:
+                # the head is a root, no edge will lead to it
+                del parent_counts[hsha]
+                head_desc.num = n
+                n = n + 1
+                head_desc.root = root_index.add_root(hsha)
+
             while build_stack:
                 parent, child_commit_desc = build_stack.pop()
+                edges += 1
                 psha = parent.hexsha
 
                 try:
@@ -107,29 +508,29 @@ refs:
                     parent_desc = klass(psha, [], [])
                     commit_desc_nodes[psha] = parent_desc
 
-                    if parent.parents:
-                        for p in parent.parents:
+                    pparents = parent.parents
+                    parent_counts[psha] = len(pparents)
+
+                    if pparents:
+                        for p in pparents:
                             build_stack.append((p, parent_desc))
                     else:
                         # current edge parent is an elder commit in the tree,
                         # that is why we should enumerate starting from it
                         to_enum = parent_desc
-                        # parent is a root
-                        parent_desc.roots = root_bit
-                        root_bit <<= 1
                 else:
                     # the existence of parent_desc means that parent has been
                     # enumerated before. Hence, we starts enumeration from
                     # it's child
                     to_enum = child_commit_desc
-                    # This parent-to-child link is just being created. So, the
-                    # root bits had not been propagated during enumeration
-                    to_enum.roots |= parent_desc.roots
                 finally:
                     parent_desc.children.append(child_commit_desc)
                     child_commit_desc.parents.append(parent_desc)
 
                 if i2y <= 0:
+                    if stats is not None:
+                        stats["edges"] = edges
+                        stats["stack_depth"] = len(build_stack)
                     yield True
                     i2y = GGB_IBY
                 else:
@@ -146,46 +547,931 @@ refs:
                     # then all parents were numbered (added) earlier
                     # according to the graph building algorithm,
                     # else we cannot assign number to the commit yet
-                    if len(e.parents) == len(repo.commit(e.sha).parents):
+                    arity_checks += 1
+                    if len(e.parents) == parent_counts[e.sha]:
+                        del parent_counts[e.sha]
                         e.num = n
                         n = n + 1
 
-                        roots = e.roots # cache the value
+                        # all parents are enumerated, join their components
+                        eparents = e.parents
+                        if eparents:
+                            r = eparents[0].root
+                            for p in eparents[1:]:
+                                r = root_index.union(r, p.root)
+                            e.root = r
+                        else:
+                            e.root = root_index.add_root(e.sha)
 
                         # according to the algorithm, only one child
                         # have no number. Other children either have
                         # been enumerated already or are not added yet
-                        chiter = iter(e.children)
-                        for c in chiter:
-                            c.roots |= roots
+                        for c in e.children:
                             if c.num is None:
                                 to_enum = c
                                 break
 
-                        # but roots must be propagated to all children
-                        for c in chiter:
-                            c.roots |= roots
-
                     if i2y <= 0:
                         yield True
                         i2y = GGB_IBY
                     else:
                         i2y -= 1
 
-        if not isinstance(refs, antiset) and refs:
-            raise ValueError("Unknown reference(s): " + ", ".join(refs))
+        yield co_normalize_roots(commit_desc_nodes.values(), root_index)
+
+        if stats is not None:
+            stats["arity_checks"] = arity_checks
+            stats["edges"] = edges
+            stats["stack_depth"] = 0
 
-        for head in repo.references:
-            hsha = head.commit.hexsha
+        attach_heads(repo, commit_desc_nodes, tips)
 
+    @classmethod
+    def co_build_git_graph_rev_list(klass, repo, commit_desc_nodes,
+        skip_remotes = False,
+        skip_stashes = False,
+        refs = None,
+        git_command = "git",
+        stats = None,
+        tips = None
+    ):
+        """
+Same as co_build_git_graph but the graph is read from one `git rev-list`
+process instead of walking GitPython objects. It is much faster on big
+repositories because no commit object is parsed by Python.
+
+git_command:
+    The git executable to launch.
+
+stats:
+    See co_build_git_graph. No arity checks are needed because parents of a
+    commit are listed together with it. There is no stack.
+
+tips:
+    Result of get_ref_tips if it is already known.
+
+Parents of a commit descriptor are listed in original order.
+        """
+
+        if tips is None:
+            tips = get_ref_tips(repo.working_dir, git_command = git_command)
+
+        selected = select_ref_tips(tips,
+            skip_remotes = skip_remotes,
+            skip_stashes = skip_stashes,
+            refs = refs
+        )
+
+        yield klass.co_extend_git_graph(repo, commit_desc_nodes,
+            list(selected.values()),
+            git_command = git_command,
+            stats = stats
+        )
+
+        if stats is not None:
+            stats["arity_checks"] = 0
+
+        attach_heads(repo, commit_desc_nodes, tips)
+
+    @classmethod
+    def co_extend_git_graph(klass, repo, commit_desc_nodes, revs,
+        exclude = (),
+        git_command = "git",
+        stats = None
+    ):
+        """ Adds ancestors of @revs to the graph using `git rev-list`.
+Ancestors of @exclude are assumed to be in @commit_desc_nodes already. Added
+commits are numbered after existing ones. New roots get next free ids.
+@stats "edges" counter is updated (see co_build_git_graph).
+        """
+
+        # iterations to yield
+        i2y = GGB_IBY
+
+        edges = 0
+
+        # Children are listed before parents. So, the order is reversed
+        # topological order.
+        rev_order = []
+
+        if revs:
+            lines = iter_rev_list(repo.working_dir,
+                list(revs) + ["^" + sha for sha in exclude],
+                git_command = git_command,
+                idle = True
+            )
+        else:
+            lines = []
+
+        for entry in lines:
+            if entry is None:
+                # git is walking the history
+                yield False
+                continue
+
+            sha, parent_shas = entry
             try:
-                desc = commit_desc_nodes[hsha]
+                desc = commit_desc_nodes[sha]
             except KeyError:
+                desc = klass(sha, [], [])
+                commit_desc_nodes[sha] = desc
+            else:
+                if desc.num is not None:
+                    # the commit was added before
+                    continue
+
+            rev_order.append(desc)
+
+            # Parents are not listed yet. Create their descriptors in advance.
+            for psha in parent_shas:
+                try:
+                    parent_desc = commit_desc_nodes[psha]
+                except KeyError:
+                    parent_desc = klass(psha, [], [])
+                    commit_desc_nodes[psha] = parent_desc
+
+                parent_desc.children.append(desc)
+                desc.parents.append(parent_desc)
+
+            edges += len(parent_shas)
+
+            if i2y <= 0:
+                if stats is not None:
+                    stats["edges"] = edges
+                yield True
+                i2y = GGB_IBY
+            else:
+                i2y -= 1
+
+        if stats is not None:
+            stats["edges"] = edges
+
+        if not rev_order:
+            return
+
+        # n is serial number according to the topology sorting
+        n = 0
+
+        if len(rev_order) < len(commit_desc_nodes):
+            # continue numbering of existing graph
+            for c in commit_desc_nodes.values():
+                if c.num is not None and c.num >= n:
+                    n = c.num + 1
+            root_index = RootIndex.from_graph(commit_desc_nodes)
+        else:
+            root_index = RootIndex()
+
+        for e in reversed(rev_order):
+            parents = e.parents
+            if parents:
+                r = parents[0].root
+                for p in parents[1:]:
+                    r = root_index.union(r, p.root)
+                e.root = r
+            else:
+                e.root = root_index.add_root(e.sha)
+
+            e.num = n
+            n += 1
+
+            if i2y <= 0:
+                yield True
+                i2y = GGB_IBY
+            else:
+                i2y -= 1
+
+        yield co_normalize_roots(commit_desc_nodes.values(), root_index)
+
+    @classmethod
+    def co_build_git_graph_commit_graph(klass, repo, commit_desc_nodes,
+        skip_remotes = False,
+        skip_stashes = False,
+        refs = None,
+        git_command = "git",
+        stats = None,
+        tips = None
+    ):
+        """
+Same as co_build_git_graph_rev_list but parents are read from the
+commit-graph file of @repo (see `git commit-graph write`). Parents of commits
+which are not covered by the file (created after it was written) are got
+using GitPython like co_build_git_graph does. If there is no commit-graph
+file then co_build_git_graph_rev_list is used.
+
+stats:
+    Counters `commit_graph_commits` and `walked_commits` are set. "edges" and
+    "stack_depth" are updated like co_build_git_graph does.
+        """
+
+        if tips is None:
+            tips = get_ref_tips(repo.working_dir, git_command = git_command)
+
+        try:
+            graph = open_commit_graph(repo.git_dir)
+        except (ValueError, KeyError, EnvironmentError) as e:
+            print("Cannot read commit-graph of '%s': %s" % (
+                repo.working_dir, e
+            ))
+            graph = None
+
+        if graph is None:
+            yield klass.co_build_git_graph_rev_list(repo, commit_desc_nodes,
+                skip_remotes = skip_remotes,
+                skip_stashes = skip_stashes,
+                refs = refs,
+                git_command = git_command,
+                stats = stats,
+                tips = tips
+            )
+            return
+
+        selected = select_ref_tips(tips,
+            skip_remotes = skip_remotes,
+            skip_stashes = skip_stashes,
+            refs = refs
+        )
+
+        try:
+            yield klass.co_extend_from_commit_graph(repo, commit_desc_nodes,
+                graph, list(selected.values()),
+                stats = stats
+            )
+        finally:
+            graph.close()
+
+        attach_heads(repo, commit_desc_nodes, tips)
+
+    @classmethod
+    def co_extend_from_commit_graph(klass, repo, commit_desc_nodes, graph,
+        revs,
+        stats = None
+    ):
+        """ Adds ancestors of @revs to an empty graph. Parents are read from
+@graph (a CommitGraphFile) where possible. Commits are numbered in post-order
+of a depth-first search over parents.
+        """
+
+        # iterations to yield
+        i2y = GGB_IBY
+
+        graph_commits = 0
+        walked_commits = 0
+        edges = 0
+
+        def parents_of(sha, pos):
+            "Returns list of (sha, position) pairs for parents of a commit."
+            if pos < 0:
+                ps = repo.commit(sha).parents
+                return [ (p.hexsha, graph.position(p.hexsha)) for p in ps ]
+            else:
+                return [ (graph.sha(p), p) for p in graph.parents(pos) ]
+
+        root_index = RootIndex()
+
+        # n is serial number according to the topology sorting
+        n = 0
+
+        for sha in revs:
+            if sha in commit_desc_nodes:
                 continue
 
-            desc.heads.append(head)
+            desc = klass(sha, [], [])
+            commit_desc_nodes[sha] = desc
+            pos = graph.position(sha)
+
+            # Frames are [desc, parents, index of next parent].
+            stack = [[desc, parents_of(sha, pos), 0]]
+            if pos < 0:
+                walked_commits += 1
+            else:
+                graph_commits += 1
+
+            while stack:
+                frame = stack[-1]
+                desc, parents, i = frame
+
+                if i < len(parents):
+                    frame[2] = i + 1
+
+                    psha, ppos = parents[i]
+                    try:
+                        parent_desc = commit_desc_nodes[psha]
+                    except KeyError:
+                        parent_desc = klass(psha, [], [])
+                        commit_desc_nodes[psha] = parent_desc
+                        stack.append([parent_desc, parents_of(psha, ppos), 0])
+                        if ppos < 0:
+                            walked_commits += 1
+                        else:
+                            graph_commits += 1
+
+                    parent_desc.children.append(desc)
+                    desc.parents.append(parent_desc)
+                    edges += 1
+                    continue
+
+                # all parents are numbered
+                stack.pop()
+
+                dparents = desc.parents
+                if dparents:
+                    r = dparents[0].root
+                    for p in dparents[1:]:
+                        r = root_index.union(r, p.root)
+                    desc.root = r
+                else:
+                    desc.root = root_index.add_root(desc.sha)
+
+                desc.num = n
+                n += 1
+
+                if i2y <= 0:
+                    if stats is not None:
+                        stats["edges"] = edges
+                        stats["stack_depth"] = len(stack)
+                    yield True
+                    i2y = GGB_IBY
+                else:
+                    i2y -= 1
+
+        yield co_normalize_roots(commit_desc_nodes.values(), root_index)
+
+        if stats is not None:
+            stats["commit_graph_commits"] = graph_commits
+            stats["walked_commits"] = walked_commits
+            stats["edges"] = edges
+            stats["stack_depth"] = 0
 
     @classmethod
     def build_git_graph(klass, *args, **kw):
         """ Wrapper for co_build_git_graph """
         callco(klass.co_build_git_graph(*args, **kw))
+
+    @classmethod
+    def build_git_graph_rev_list(klass, *args, **kw):
+        """ Wrapper for co_build_git_graph_rev_list """
+        callco(klass.co_build_git_graph_rev_list(*args, **kw))
+
+    @classmethod
+    def build_git_graph_commit_graph(klass, *args, **kw):
+        """ Wrapper for co_build_git_graph_commit_graph """
+        callco(klass.co_build_git_graph_commit_graph(*args, **kw))
+
+    @classmethod
+    def build_git_graph_cached(klass, *args, **kw):
+        """ Wrapper for co_build_git_graph_cached. Returns True if the graph
+was loaded and not changed.
+        """
+
+        stats = kw.get("stats", None)
+        if stats is None:
+            stats = kw["stats"] = {}
+
+        callco(klass.co_build_git_graph_cached(*args, **kw))
+
+        return bool(stats["loaded"])
+
+    @classmethod
+    def co_build_git_graph_cached(klass, repo, commit_desc_nodes, file_name,
+        skip_remotes = False,
+        skip_stashes = False,
+        refs = None,
+        git_command = "git",
+        stats = None,
+        tips = None
+    ):
+        """ Same as co_build_git_graph_rev_list but the graph is loaded from
+@file_name if it exists. Only commits reachable from moved references are
+added then. The result is saved to @file_name.
+
+stats:
+    Counter "loaded" is set to 1 if the graph was loaded and not changed.
+    See co_extend_git_graph for others.
+        """
+
+        if tips is None:
+            tips = get_ref_tips(repo.working_dir, git_command = git_command)
+
+        selected = select_ref_tips(tips,
+            skip_remotes = skip_remotes,
+            skip_stashes = skip_stashes,
+            refs = refs
+        )
+
+        old_tips = None
+        if isfile(file_name):
+            try:
+                old_tips = klass.load_git_graph(file_name, commit_desc_nodes)
+            except Exception as e:
+                print("Cannot load graph snapshot '%s': %s" % (file_name, e))
+
+        if old_tips is not None and old_tips == selected:
+            attach_heads(repo, commit_desc_nodes, tips)
+            if stats is not None:
+                stats["loaded"] = 1
+            return
+
+        if old_tips is not None:
+            # If a reference was removed or moved then commits reachable from
+            # its old tip only must not be in the graph.
+            gone = [
+                sha for path, sha in old_tips.items()
+                    if selected.get(path, None) != sha
+            ]
+            if gone:
+                try:
+                    orphaned = list(iter_rev_list(repo.working_dir,
+                        gone + ["^" + sha for sha in selected.values()],
+                        git_command = git_command,
+                        options = ("--max-count=1",)
+                    ))
+                except LaunchFailed:
+                    # E.g., an old tip was garbage collected.
+                    orphaned = True
+
+                if orphaned:
+                    old_tips = None
+
+        if old_tips is None:
+            commit_desc_nodes.clear()
+            exclude = []
+        else:
+            exclude = list(set(old_tips.values()))
+
+        yield klass.co_extend_git_graph(repo, commit_desc_nodes,
+            [sha for sha in selected.values() if sha not in commit_desc_nodes],
+            exclude = exclude,
+            git_command = git_command,
+            stats = stats
+        )
+
+        attach_heads(repo, commit_desc_nodes, tips)
+
+        klass.save_git_graph(file_name, commit_desc_nodes, selected)
+
+        if stats is not None:
+            stats["loaded"] = 0
+
+    @staticmethod
+    def save_git_graph(file_name, commit_desc_nodes, tips):
+        """ Saves parents, `num` and `root` of commits to a binary file.
+@tips is a mapping from reference paths to SHA1 the graph is built for.
+        """
+
+        descs = list(commit_desc_nodes.values())
+        desc2idx = dict((id(c), i) for i, c in enumerate(descs))
+
+        # All columns are 32-bit integers.
+        nums = array("i", (-1 if c.num is None else c.num for c in descs))
+        parent_counts = array("I", (len(c.parents) for c in descs))
+        roots = array("i", (-1 if c.root is None else c.root for c in descs))
+        parents = array("I")
+        for c in descs:
+            parents.extend(desc2idx[id(p)] for p in c.parents)
+
+        tip_records = []
+        for path, sha in tips.items():
+            path = path.encode("utf-8")
+            tip_records.append(unhexlify(sha) + pack("<L", len(path)) + path)
+
+        columns = [b"".join(unhexlify(c.sha) for c in descs)]
+        for a in (nums, roots, parent_counts, parents):
+            if sys.byteorder != "little":
+                a.byteswap()
+            columns.append(array_to_bytes(a))
+
+        f = open(file_name + ".tmp", "wb")
+        f.write(GRAPH_FILE_MAGIC)
+        f.write(pack("<LLL", len(tip_records), len(descs), len(parents)))
+        f.write(b"".join(tip_records))
+        for col in columns:
+            f.write(col)
+        f.close()
+
+        if isfile(file_name):
+            unlink(file_name)
+        rename(file_name + ".tmp", file_name)
+
+    @classmethod
+    def load_git_graph(klass, file_name, commit_desc_nodes):
+        """ Loads a graph saved by save_git_graph to @commit_desc_nodes.
+`heads` are not saved and must be attached after loading.
+
+Returns the mapping of reference tips the graph was built for.
+        """
+
+        f = open(file_name, "rb")
+        data = f.read()
+        f.close()
+
+        if not data.startswith(GRAPH_FILE_MAGIC):
+            raise ValueError("Not a graph file")
+
+        offset = len(GRAPH_FILE_MAGIC)
+        tips_count, count, parents_count = unpack_from("<LLL", data, offset)
+        offset += 12
+
+        tips = OrderedDict()
+        for _ in range(tips_count):
+            sha = hexlify(data[offset:offset + 20]).decode("ascii")
+            path_len, = unpack_from("<L", data, offset + 20)
+            offset += 24
+            path = data[offset:offset + path_len].decode("utf-8")
+            offset += path_len
+            tips[path] = sha
+
+        shas = hexlify(data[offset:offset + 20 * count]).decode("ascii")
+        offset += 20 * count
+
+        columns = []
+        for typecode, size in (("i", count), ("i", count), ("I", count),
+            ("I", parents_count)
+        ):
+            a = array(typecode)
+            array_from_bytes(a, data[offset:offset + 4 * size])
+            if sys.byteorder != "little":
+                a.byteswap()
+            offset += 4 * size
+            columns.append(a)
+
+        if offset != len(data):
+            raise ValueError("Graph file size mismatch")
+
+        nums, roots, parent_counts, parents = columns
+
+        descs = []
+        for i in range(count):
+            c = klass(shas[i * 40:(i + 1) * 40], [], [])
+            num = nums[i]
+            if num >= 0:
+                c.num = num
+            root = roots[i]
+            if root >= 0:
+                c.root = root
+            descs.append(c)
+
+        pi = 0
+        for c, parent_count in zip(descs, parent_counts):
+            for p in parents[pi:pi + parent_count]:
+                p = descs[p]
+                c.parents.append(p)
+                p.children.append(c)
+            pi += parent_count
+
+        for c in descs:
+            commit_desc_nodes[c.sha] = c
+
+        return tips
+
+def co_normalize_roots(descs, root_index):
+    """ Replaces component ids (`root`) of commits with ids of components
+those are result of all unions.
+    """
+
+    # iterations to yield
+    i2y = GGB_IBY
+
+    find = root_index.find
+
+    for c in descs:
+        r = c.root
+        if r is not None:
+            c.root = find(r)
+
+        if i2y <= 0:
+            yield True
+            i2y = GGB_IBY
+        else:
+            i2y -= 1
+
+GRAPH_FILE_MAGIC = b"GICGRAPH\x02"
+
+if sys.version_info[0] == 3:
+    def array_to_bytes(a):
+        return a.tobytes()
+
+    def array_from_bytes(a, data):
+        a.frombytes(data)
+else:
+    def array_to_bytes(a):
+        return a.tostring()
+
+    def array_from_bytes(a, data):
+        a.fromstring(data)
+
+class CatFile(object):
+    """ A long-lived `git cat-file` process of a repository. @mode is either
+"--batch" or "--batch-check". Objects and references are looked up anew by
+each query. So, changes made by other processes are seen.
+    """
+
+    def __init__(self, repo_path, mode, git_command = "git"):
+        self.mode = mode
+        self.process = Popen([git_command, "-C", repo_path, "cat-file", mode],
+            stdin = PIPE,
+            stdout = PIPE
+        )
+
+    def query(self, rev):
+        """ Returns (SHA1, type, size) for "--batch-check" mode and (SHA1,
+type, content) for "--batch" mode. Values are bytes except for the size. @rev
+can be any revision expression (e.g., "HEAD^{tree}"). Returns None if there is
+no such object.
+        """
+
+        if not isinstance(rev, bytes):
+            rev = rev.encode("utf-8")
+
+        p = self.process
+        p.stdin.write(rev + b"\n")
+        p.stdin.flush()
+
+        header = p.stdout.readline()
+        if not header:
+            raise RuntimeError("git cat-file %s has exited" % self.mode)
+
+        fields = header.split()
+        if len(fields) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            return None
+
+        sha, otype, size = fields
+        size = int(size)
+
+        if self.mode == "--batch":
+            content = p.stdout.read(size)
+            p.stdout.read(1) # LF
+            return sha, otype, content
+        else:
+            return sha, otype, size
+
+    def close(self):
+        p = self.process
+        p.stdin.close()
+        p.stdout.close()
+        p.wait()
+
+class CatFilePool(object):
+    """ CatFile processes of several repositories. They are started on
+demand, one per repository and mode. `queries` is the number of queries made.
+`spawns` is the number of processes started.
+    """
+
+    def __init__(self, git_command = "git"):
+        self.git_command = git_command
+        self._cat_files = {}
+        self.queries = 0
+        self.spawns = 0
+
+    def _get(self, repo_path, mode):
+        key = (repo_path, mode)
+        try:
+            return self._cat_files[key]
+        except KeyError:
+            pass
+
+        cat_file = CatFile(repo_path, mode, git_command = self.git_command)
+        self._cat_files[key] = cat_file
+        self.spawns += 1
+        return cat_file
+
+    def info(self, repo_path, rev):
+        "Returns (SHA1, type, size) of @rev or None. See CatFile.query."
+        self.queries += 1
+        return self._get(repo_path, "--batch-check").query(rev)
+
+    def read(self, repo_path, rev):
+        "Returns (SHA1, type, content) of @rev or None. See CatFile.query."
+        self.queries += 1
+        return self._get(repo_path, "--batch").query(rev)
+
+    def sha(self, repo_path, rev):
+        "Returns SHA1 of @rev or None."
+        info = self.info(repo_path, rev)
+        return None if info is None else info[0]
+
+    def close(self):
+        "Stops all processes. They will be restarted on demand."
+
+        for cat_file in self._cat_files.values():
+            cat_file.close()
+        self._cat_files.clear()
+
+# References those are per working tree (see `git help worktree`).
+PER_WORKTREE_REFS = ("refs/bisect/", "refs/worktree/", "refs/rewritten/")
+
+class RefReader(object):
+    """ Resolves references of repositories by reading files in `.git`:
+`HEAD`, loose references and `packed-refs`. Parsed `packed-refs` files are kept
+until they are changed. `git rev-parse` is launched for unusual setups only
+(e.g., reftable storage or an unexpected file content). `reads` is the number of
+resolved references and `fallbacks` is the number of `git` launches.
+    """
+
+    def __init__(self, git_command = "git"):
+        self.git_command = git_command
+        # packed-refs file name -> ((mtime, size), {ref: sha})
+        self._packed = {}
+        self.reads = 0
+        self.fallbacks = 0
+
+    def resolve(self, repo_path, ref = "HEAD"):
+        "Returns SHA1 (bytes) of @ref or None if @ref does not exist."
+
+        self.reads += 1
+
+        try:
+            sha = self._resolve(repo_path, ref)
+        except (IOError, OSError, ValueError):
+            sha = False
+
+        if sha is False:
+            self.fallbacks += 1
+            try:
+                _stdout, _ = launch([self.git_command, "-C", repo_path,
+                    "rev-parse", "-q", "--verify", ref
+                ])
+            except LaunchFailed:
+                return None
+            sha = _stdout.strip()
+
+        return sha
+
+    def _resolve(self, repo_path, ref):
+        "Returns False if the setup is not supported."
+
+        git_dir, common_dir = self.git_dirs(repo_path)
+        if git_dir is None:
+            return False
+
+        for _ in range(5): # as `git` does, see SYMREF_MAXDEPTH
+            if ref.startswith("refs/") and not ref.startswith(
+                PER_WORKTREE_REFS
+            ):
+                ref_dir = common_dir
+            else:
+                ref_dir = git_dir
+
+            try:
+                with open(join(ref_dir, ref), "rb") as f:
+                    content = f.read().strip()
+            except (IOError, OSError):
+                if ref == "HEAD" or not ref.startswith("refs/"):
+                    return False
+                # no loose reference
+                return self._packed_refs(common_dir).get(ref.encode("utf-8"))
+
+            if content.startswith(b"ref: "):
+                ref = content[5:].decode("utf-8")
+                if ref == "refs/heads/.invalid":
+                    # reftable
+                    return False
+                continue
+
+            if len(content) in (40, 64):
+                int(content, 16) # raises ValueError if it is not a SHA
+                return content
+
+            return False
+
+        return False
+
+    def git_dirs(self, repo_path):
+        """ Returns (git directory, common directory) of a working tree or
+(None, None).
+        """
+
+        git_dir = join(repo_path, ".git")
+
+        if isfile(git_dir):
+            # `gitdir: ` file of a linked working tree or a submodule
+            with open(git_dir, "rb") as f:
+                content = f.read().strip()
+            if not content.startswith(b"gitdir: "):
+                return None, None
+            git_dir = content[8:].decode("utf-8")
+            if not isabs(git_dir):
+                git_dir = join(repo_path, git_dir)
+        elif not isdir(git_dir):
+            return None, None
+
+        common_file = join(git_dir, "commondir")
+        if isfile(common_file):
+            with open(common_file, "rb") as f:
+                common_dir = f.read().strip().decode("utf-8")
+            if not isabs(common_dir):
+                common_dir = join(git_dir, common_dir)
+        else:
+            common_dir = git_dir
+
+        return git_dir, common_dir
+
+    def _packed_refs(self, common_dir):
+        file_name = join(common_dir, "packed-refs")
+
+        try:
+            st = stat(file_name)
+        except (IOError, OSError):
+            return {}
+
+        key = (st.st_mtime, st.st_size)
+        try:
+            cached_key, refs = self._packed[file_name]
+        except KeyError:
+            pass
+        else:
+            if cached_key == key:
+                return refs
+
+        refs = {}
+        with open(file_name, "rb") as f:
+            for line in f:
+                # skip the header and peeled tags
+                if line.startswith((b"#", b"^")):
+                    continue
+                sha, _, name = line.rstrip(b"\n").partition(b" ")
+                refs[name] = sha
+
+        self._packed[file_name] = (key, refs)
+        return refs
+
+class RefSnapshot(OrderedDict):
+    """ An ordered mapping from reference paths to SHA1 of commits those
+references pointed to when get_ref_tips was called. It is read once per run
+and shared by all consumers instead of resolving `repo.references` again.
+    """
+
+    def iter_prefix(self, prefix):
+        """ Yields (name, sha) for references whose paths start with @prefix.
+The name is the path without @prefix.
+        """
+
+        plen = len(prefix)
+        for path, sha in self.items():
+            if path.startswith(prefix):
+                yield path[plen:], sha
+
+def get_ref_tips(repo_path, git_command = "git"):
+    """ Returns a RefSnapshot of a repository. Annotated tags are peeled.
+References to other objects are ignored.
+    """
+
+    _stdout, _ = launch([git_command, "-C", repo_path, "for-each-ref",
+            "--format=%(objecttype) %(objectname) %(*objecttype) "
+                "%(*objectname) %(refname)"
+        ],
+        epfx = "Cannot list references of '%s'" % repo_path
+    )
+
+    tips = RefSnapshot()
+    for line in _stdout.decode("utf-8").splitlines():
+        otype, sha, ptype, psha, path = line.split(" ", 4)
+        if otype == "tag":
+            otype, sha = ptype, psha
+        if otype == "commit":
+            tips[path] = sha
+
+    return tips
+
+def select_ref_tips(tips,
+    skip_remotes = False,
+    skip_stashes = False,
+    refs = None
+):
+    """ Filters result of get_ref_tips. See co_build_git_graph for arguments
+meaning.
+    """
+
+    refs = antiset() if refs is None else set(refs)
+
+    selected = OrderedDict()
+    for path, sha in tips.items():
+        if skip_remotes and path.startswith("refs/remotes/"):
+            continue
+        if skip_stashes and path.startswith("refs/stash"):
+            continue
+
+        if path in refs:
+            refs.remove(path) # unknown reference detection
+        else:
+            continue
+
+        selected[path] = sha
+
+    if not isinstance(refs, antiset) and refs:
+        raise ValueError("Unknown reference(s): " + ", ".join(refs))
+
+    return selected
+
+def attach_heads(repo, commit_desc_nodes, tips):
+    """ Fills `heads` list of descriptors of commits referenced by @repo.
+@tips is a RefSnapshot of @repo (see get_ref_tips).
+    """
+
+    for path, sha in tips.items():
+        try:
+            desc = commit_desc_nodes[sha]
+        except KeyError:
+            continue
+
+        desc.heads.append(Reference.from_path(repo, path))
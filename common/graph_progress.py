@@ -0,0 +1,146 @@
+__all__ = [
+    "GraphBuildProgress"
+]
+
+from .co_dispatcher import (
+    CoDispatcher,
+    CoTask,
+    FailedCallee
+)
+from time import time
+import json
+import sys
+
+class GraphBuildProgress(object):
+    """ Runs a graph building coroutine by a CoDispatcher together with a
+reporter task. The reporter periodically prints the number of commits in the
+graph, the rate, counters the builder updates in @stats (see
+CommitDesc.co_build_git_graph), elapsed time and an estimated time of arrival.
+Builders reading `git rev-list` yield while git is walking the history (see
+iter_rev_list). So, reports are printed during that phase too.
+
+expected:
+    Expected number of commits. The ETA is only printed if it is given.
+
+period:
+    Seconds between reports.
+    """
+
+    def __init__(self, commit_desc_nodes, stats,
+        expected = None,
+        period = 1.,
+        out = sys.stdout
+    ):
+        self.commit_desc_nodes = commit_desc_nodes
+        self.stats = stats
+        self.expected = expected
+        self.period = period
+        self.out = out
+
+        self.started = None
+        self.finished = None
+        self.reports = 0
+        self.max_stack_depth = 0
+
+    def commits(self):
+        # A builder may count commits itself if the graph does not grow
+        # during building (e.g. CompactGraph).
+        try:
+            return self.stats["commits"]
+        except KeyError:
+            return len(self.commit_desc_nodes)
+
+    def run(self, co):
+        """ Runs the building coroutine @co. Returns the summary. An exception
+raised by the builder is raised again.
+        """
+
+        disp = CoDispatcher()
+        task = CoTask(co)
+        disp.enqueue(task)
+        disp.enqueue(self.co_report(disp, task))
+
+        self.started = time()
+
+        while disp.has_work():
+            disp.iteration()
+
+        self.finished = time()
+
+        e = task.exception
+        # look for the origin of the failure in the call chain
+        while isinstance(e, FailedCallee):
+            e = e.callee.exception
+        if e is not None:
+            raise e
+
+        return self.summary()
+
+    def co_report(self, dispatcher, task):
+        period = self.period
+
+        last_time = time()
+        last_commits = 0
+
+        while task not in dispatcher.finished_tasks \
+        and task not in dispatcher.failed_tasks:
+            t = time()
+            if t - last_time < period:
+                yield False
+                continue
+
+            commits = self.commits()
+            rate = (commits - last_commits) / (t - last_time)
+            last_time, last_commits = t, commits
+
+            self.report(commits, rate)
+
+            yield False
+
+        self.sample()
+
+    def sample(self):
+        stack_depth = self.stats.get("stack_depth", 0)
+        if stack_depth > self.max_stack_depth:
+            self.max_stack_depth = stack_depth
+        return stack_depth
+
+    def report(self, commits, rate):
+        stack_depth = self.sample()
+        self.reports += 1
+
+        line = "Graph: %d commits (%.0f/sec), %d edges, stack %d, %.0f sec" % (
+            commits, rate, self.stats.get("edges", 0), stack_depth,
+            time() - self.started
+        )
+
+        expected = self.expected
+        if expected is not None and rate > 0:
+            line += ", ETA %.0f sec" % (max(expected - commits, 0) / rate)
+
+        self.out.write(line + "\n")
+        self.out.flush()
+
+    def summary(self):
+        "Returns a dict with final counters and timings."
+
+        ret = dict(self.stats)
+        ret.pop("stack_depth", None)
+
+        commits = self.commits()
+        seconds = (self.finished or time()) - self.started
+
+        ret["commits"] = commits
+        ret["seconds"] = seconds
+        ret["commits_per_second"] = (commits / seconds) if seconds else 0.
+        ret["max_stack_depth"] = self.max_stack_depth
+
+        return ret
+
+    def write_summary(self, file_name):
+        "Saves the summary to a JSON file."
+
+        f = open(file_name, "w")
+        json.dump(self.summary(), f, indent = 4, sort_keys = True)
+        f.write("\n")
+        f.close()
@@ -0,0 +1,82 @@
+__all__ = [
+    "Journal"
+  , "read_journal"
+]
+
+from os import fsync
+from os.path import isfile
+from ast import literal_eval
+from time import time
+
+class Journal(object):
+    """ Append-only file of records. A record is a Python literal (tuples,
+lists, dicts, strings, numbers...) written by `repr` in one line.
+
+Each record is flushed at once. So, it survives a killed process. Records are
+synchronized with the disk (`fsync`) in batches: after @sync_every records or
+@sync_interval seconds since previous synchronization. So, a system crash can
+lose only last batch.
+    """
+
+    def __init__(self, file_name, sync_every = 100, sync_interval = 1.):
+        self.file_name = file_name
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        self._file = open(file_name, "ab")
+        self._unsynced = 0
+        self._synced_at = time()
+
+    def append(self, record):
+        f = self._file
+        f.write(repr(record).encode("utf-8") + b"\n")
+        f.flush()
+
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_every
+        or time() - self._synced_at >= self.sync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        if self._unsynced:
+            fsync(self._file.fileno())
+            self._unsynced = 0
+        self._synced_at = time()
+
+    def truncate(self):
+        "Removes all records (e.g., when they are saved somewhere else)."
+
+        f = self._file
+        f.seek(0)
+        f.truncate()
+        f.flush()
+        fsync(f.fileno())
+        self._unsynced = 0
+        self._synced_at = time()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+def read_journal(file_name):
+    """ Returns the list of records of a Journal. A torn last record (the
+writer was killed while writing it) is ignored.
+    """
+
+    records = []
+
+    if not isfile(file_name):
+        return records
+
+    with open(file_name, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = literal_eval(line.decode("utf-8"))
+            except (SyntaxError, ValueError, UnicodeDecodeError):
+                break
+            records.append(record)
+
+    return records
@@ -37,15 +37,29 @@ class LaunchFailed(Exception):
         self._stdout = _stdout
         self._stderr = _stderr
 
-def launch(cmd, epfx = None, flush = False):
-    p = Popen(cmd, stdout = PIPE, stderr = PIPE)
+def launch(cmd, epfx = None, flush = False, input = None, env = None,
+    cwd = None
+):
+    """ Runs @cmd and returns its output. @input (bytes) is written to its
+standard input. @env replaces the environment. @cwd is the working directory
+of the command (the current one by default).
+    """
+    p = Popen(cmd,
+        stdin = None if input is None else PIPE,
+        stdout = PIPE,
+        stderr = PIPE,
+        env = env,
+        cwd = cwd
+    )
 
-    _stdout, _stderr = p.communicate()
+    _stdout, _stderr = p.communicate(input)
     returncode = p.returncode
 
     if returncode:
         if epfx is None:
-            error_prefix = "Launch of command %s has failed" % " ".join(cmd)
+            error_prefix = "Launch of command %s has failed" % " ".join(
+                (a.decode("utf-8") if isinstance(a, bytes) else a) for a in cmd
+            )
         else:
             error_prefix = epfx
 
@@ -0,0 +1,126 @@
+__all__ = [
+    "RootIndex"
+  , "commits_sharing_roots"
+]
+
+class RootIndex(object):
+    """ Disjoint set (union-find) of history roots. Each root commit is given a
+dense integer id. When a commit has ancestors in several components those
+components are united. A component is identified by the id of one of its
+roots (the representative) and has the list of SHA1 of its roots.
+    """
+
+    __slots__ = ["_parent", "_size", "_roots"]
+
+    def __init__(self):
+        self._parent = []
+        self._size = []
+        self._roots = []
+
+    def add_root(self, sha):
+        "Registers a new root commit. Returns its component id."
+
+        i = len(self._parent)
+        self._parent.append(i)
+        self._size.append(1)
+        self._roots.append([sha])
+        return i
+
+    def find(self, i):
+        "Returns current component id of root or component @i."
+
+        parent = self._parent
+        while parent[i] != i:
+            # path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, a, b):
+        "Unites components @a and @b. Returns id of resulting component."
+
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return a
+
+        size = self._size
+        if size[a] < size[b]:
+            a, b = b, a
+
+        self._parent[b] = a
+        size[a] += size[b]
+        self._roots[a].extend(self._roots[b])
+        self._roots[b] = []
+        return a
+
+    def roots(self, comp):
+        "Returns list of SHA1 of roots of the component."
+        return self._roots[self.find(comp)]
+
+    def components(self):
+        "Returns list of component ids."
+        return [ i for i, p in enumerate(self._parent) if p == i ]
+
+    def __len__(self):
+        "Number of roots."
+        return len(self._parent)
+
+    @classmethod
+    def from_graph(klass, commit_desc_nodes):
+        """ Restores the index of a built graph. Commits must have final
+component ids in `root` attribute.
+        """
+
+        roots = []
+        for c in commit_desc_nodes.values():
+            if not c.parents and c.root is not None:
+                roots.append((c.root, c.sha))
+
+        self = klass()
+        # Ids of roots those are not representatives are not referenced by
+        # commits. They are kept as empty singletons to preserve id space.
+        count = len(roots)
+        self._parent = list(range(count))
+        self._size = [1] * count
+        self._roots = [ [] for _ in range(count) ]
+        for comp, sha in roots:
+            self._roots[comp].append(sha)
+
+        return self
+
+def commits_sharing_roots(commit_desc_nodes, sha):
+    """ Returns set of SHA1 of commits having at least one common root with
+the commit @sha (including itself). I.e. descendants of its roots.
+    """
+
+    c = commit_desc_nodes[sha]
+
+    # find roots of the commit
+    roots = []
+    visited = set([c.sha])
+    stack = [c]
+    while stack:
+        a = stack.pop()
+        parents = a.parents
+        if not parents:
+            roots.append(a)
+            continue
+        for p in parents:
+            psha = p.sha
+            if psha not in visited:
+                visited.add(psha)
+                stack.append(p)
+
+    # descendants of the roots
+    ret = set(r.sha for r in roots)
+    stack = roots
+    while stack:
+        d = stack.pop()
+        for ch in d.children:
+            chsha = ch.sha
+            if chsha not in ret:
+                ret.add(chsha)
+                stack.append(ch)
+
+    return ret
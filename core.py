@@ -1,15 +1,59 @@
 __all__ = [
     "GICCommitDesc"
+  , "GICCompactGraph"
+  , "detect_subtrees"
+  , "load_action_timings"
+  , "save_action_timings"
+  , "estimate_actions"
   , "plan"
+  , "plan_shards"
+  , "CloneShards"
   , "load_context"
 ]
 
-from common import CommitDesc
+from common import (
+    CommitDesc,
+    commits_sharing_roots,
+    get_ref_tips,
+    read_commit_metadata,
+    CompactCommit,
+    CompactGraph,
+    compact_flag,
+    compact_attribute,
+    select_ref_tips,
+    read_journal
+)
 
 from actions import *
 
-from os.path import abspath
-
+from git import Repo
+from git.cmd import Git
+
+from multiprocessing import (
+    cpu_count,
+    Pool
+)
+
+from os.path import (
+    abspath,
+    dirname,
+    isfile,
+    join
+)
+from os import (
+    makedirs,
+    rename,
+    unlink
+)
+from traceback import print_exc
+
+from collections import OrderedDict
+from heapq import (
+    heapify,
+    heappop,
+    heappush
+)
+import json
 import sys
 
 if sys.version_info[0] != 2:
@@ -37,6 +81,117 @@ class GICCommitDesc(CommitDesc):
         self.skipped = False
         self.used = False
 
+class GICCompactCommit(CompactCommit):
+    "GICCommitDesc compatible view of a commit in GICCompactGraph."
+
+    __slots__ = []
+
+    used = compact_flag("used")
+    skipped = compact_flag("skipped")
+    processed = compact_flag("processed")
+    cloned_sha = compact_attribute("cloned_sha")
+
+class GICCompactGraph(CompactGraph):
+    "Memory efficient alternative to a dict of GICCommitDesc."
+
+    commit_type = GICCompactCommit
+    flags = ("used", "skipped", "processed")
+    attributes = ("cloned_sha",)
+
+    def propagate_used(self):
+        "See propagate_used function. It works on flag arrays directly."
+
+        used = self._flag_used
+        skipped = self._flag_skipped
+        ps = self._parent_start
+        parent_ids = self._parent_ids
+
+        for i in reversed(self._by_num):
+            if skipped[i] or not used[i]:
+                continue
+            for p in parent_ids[ps[i]:ps[i + 1]]:
+                if not skipped[p]:
+                    used[p] = 1
+
+def propagate_used(sha2commit, queue):
+    """ Marks ancestors of used commits as used. A skipped commit neither
+becomes used nor passes the flag to its ancestors. @queue lists all commits
+of @sha2commit in topological order (by `num`). It is swept once backward.
+So, children are finished before their parents.
+    """
+
+    if isinstance(sha2commit, GICCompactGraph):
+        sha2commit.propagate_used()
+        return
+
+    for c in reversed(queue):
+        if c.skipped or not c.used:
+            continue
+        for p in c.parents:
+            if not p.skipped:
+                p.used = True
+
+def order_commits(queue, first_parents):
+    """ Returns another topological order of commits of @queue those tends to
+keep branches contiguous. @first_parents maps SHA1 of a commit to SHA1 of its
+first parent or None.
+
+The cost of a checkout is estimated by the distance between the previous
+commit and the first parent of next commit in the new order. A child of the
+previous commit is zero cost. Otherwise, the commit whose first parent is
+ordered most recently is taken: its working tree is likely close to the
+current one. New trunks (roots) are started when nothing else is ready. Ties
+are broken by the original order.
+    """
+
+    index = {}
+    waiting = {}
+    ready = []
+
+    for i, c in enumerate(queue):
+        index[c.sha] = i
+        waiting[c.sha] = len(c.parents)
+        if not c.parents:
+            ready.append((1, 0, i))
+
+    heapify(ready)
+
+    # SHA1 -> position in the new order
+    position = {}
+    order = []
+
+    while ready:
+        _, _, i = heappop(ready)
+        c = queue[i]
+
+        position[c.sha] = len(order)
+        order.append(c)
+
+        for ch in c.children:
+            chsha = ch.sha
+            waiting[chsha] -= 1
+            if waiting[chsha]:
+                continue
+
+            heappush(ready,
+                (0, -position[first_parents[chsha]], index[chsha])
+            )
+
+    return order
+
+def count_checkouts(queue, first_parents):
+    """ Returns the number of commits in @queue whose first parent is not the
+previous commit (see order_commits). `plan` checks them out.
+    """
+
+    checkouts = 0
+    prev = None
+    for c in queue:
+        if prev is not None and first_parents[c.sha] != prev:
+            checkouts += 1
+        prev = c.sha
+    return checkouts
+
 def is_subtree(c, acceptable = 4):
     """ Heuristically detect a subtree merge.
 
@@ -55,49 +210,272 @@ def is_subtree(c, acceptable = 4):
     @acceptable is a threshold to handle such cases.
     """
 
-    p1 = c.parents[1]
-    d = p1.diff(c)
+    return find_subtree_prefix(c.repo.git, c.hexsha, c.parents[1].hexsha,
+        acceptable = acceptable
+    )
 
-    # suggest a prefix
-    for probe in d:
-        if probe.renamed:
-            break
-    else:
-        return None
+def find_subtree_prefix(git, c_sha, p1_sha, acceptable = 4):
+    """ is_subtree for a merge commit @c_sha with second parent @p1_sha.
+@git is a git.cmd.Git of the repository.
+    """
 
-    if probe.b_path.endswith(probe.a_path):
-        prefix = probe.b_path[:-len(probe.a_path)]
-    else:
+    # Fields of `git diff-tree -z --name-status` output are: status, path and
+    # one more path for a rename (or a copy).
+    fields = git.diff_tree(p1_sha, c_sha,
+        "-r", "-M", "--name-status", "-z"
+    ).split("\0")
+
+    prefix = None
+    renames = set()
+    new_files = set()
+
+    i = 0
+    while i + 1 < len(fields):
+        status = fields[i][:1]
+        if status in ("R", "C"):
+            a_path, b_path = fields[i + 1], fields[i + 2]
+            i += 3
+        else:
+            i += 2
+            if status == "A":
+                new_files.add(fields[i - 1])
+            continue
+
+        if status != "R":
+            continue
+
+        if prefix is None:
+            # suggest a prefix using first rename
+            if b_path.endswith(a_path):
+                prefix = b_path[:-len(a_path)]
+            else:
+                return None
+
+        renames.add((a_path, b_path))
+
+    if prefix is None:
         return None
 
     # Were all parent files renamed using same prefix?
-    for po in p1.tree.traverse():
-        if po.type != "blob":
+    for entry in git.ls_tree("-r", "-z", p1_sha).split("\0"):
+        if not entry:
             continue
 
-        new_path = prefix + po.path
+        info, path = entry.split("\t", 1)
+        if info.split(" ", 2)[1] != "blob":
+            continue
 
-        for check in d:
-            if check.renamed:
-                if check.rename_from == po.path \
-                and check.rename_to == new_path:
-                    break
-            elif check.new_file:
-                if check.b_path == new_path:
-                    break
-        else:
-            # no such difference
-            if not acceptable:
-                return None
-            else:
-                acceptable -= 1
-                # print(po.path + " ACC")
-                continue
+        new_path = prefix + path
+
+        if (path, new_path) in renames or new_path in new_files:
+            # print(path + " OK")
+            continue
 
-        # print(po.path + " OK")
+        # no such difference
+        if not acceptable:
+            return None
+        else:
+            acceptable -= 1
+            # print(path + " ACC")
 
     return prefix
 
+def _detect_subtree(task):
+    "Worker of detect_subtrees."
+
+    repo_path, c_sha, p1_sha, acceptable = task
+    return c_sha, find_subtree_prefix(Git(repo_path), c_sha, p1_sha,
+        acceptable = acceptable
+    )
+
+SUBTREES_FILE_VERSION = 1
+
+def detect_subtrees(repo, sha2commit,
+    file_name = None,
+    acceptable = 4,
+    workers = None,
+    stats = None,
+    detect = True
+):
+    """ Runs is_subtree for each two-parent merge of the graph in a pool of
+@workers processes (CPU count by default). Results are loaded from and saved
+to @file_name (JSON) if it is given. A result depends on the merge only. So,
+the file remains valid for any plan of any repository.
+
+Returns a mapping from SHA1 of a merge to the subtree prefix or None. See
+`subtrees` argument of `plan`.
+
+If not @detect, only loaded results are used. Other merges are mapped to None
+(usual merges) and nothing is saved. E.g., it's enough for an estimation.
+
+stats:
+    A dict to put "loaded" and "detected" counters into.
+    """
+
+    subtrees = {}
+
+    if file_name is not None and isfile(file_name):
+        try:
+            f = open(file_name, "r")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+
+            if data["version"] != SUBTREES_FILE_VERSION:
+                raise ValueError("unsupported version %r" % data["version"])
+
+            if data["acceptable"] == acceptable:
+                subtrees.update(data["subtrees"])
+        except (ValueError, KeyError, TypeError, EnvironmentError) as e:
+            print("Cannot load subtree detection results '%s': %s" % (
+                file_name, e
+            ))
+
+    loaded = len(subtrees)
+
+    repo_path = repo.working_dir
+    tasks = []
+    for c in sha2commit.values():
+        parents = c.parents
+        if len(parents) != 2:
+            continue
+        c_sha = c.sha
+        if c_sha in subtrees:
+            continue
+        if detect:
+            tasks.append((repo_path, c_sha, parents[1].sha, acceptable))
+        else:
+            subtrees[c_sha] = None
+
+    if workers is None:
+        workers = cpu_count()
+    workers = max(1, min(workers, len(tasks)))
+
+    if workers > 1:
+        pool = Pool(workers)
+        try:
+            subtrees.update(pool.imap_unordered(_detect_subtree, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        subtrees.update(_detect_subtree(t) for t in tasks)
+
+    if tasks and file_name is not None:
+        f = open(file_name + ".tmp", "w")
+        json.dump(dict(
+                version = SUBTREES_FILE_VERSION,
+                acceptable = acceptable,
+                subtrees = subtrees
+            ),
+            f,
+            indent = 0,
+            sort_keys = True
+        )
+        f.close()
+
+        if isfile(file_name):
+            unlink(file_name)
+        rename(file_name + ".tmp", file_name)
+
+    if stats is not None:
+        stats["loaded"] = loaded
+        stats["detected"] = len(tasks)
+
+    return subtrees
+
+ACTION_TIMINGS_FILE_VERSION = 1
+
+def load_action_timings(file_name):
+    """ Loads a mapping from action type names to (count, seconds) saved by
+save_action_timings. Returns an empty mapping if there is no such file or it
+cannot be loaded.
+    """
+
+    timings = {}
+
+    if not isfile(file_name):
+        return timings
+
+    try:
+        f = open(file_name, "r")
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+
+        if data["version"] != ACTION_TIMINGS_FILE_VERSION:
+            raise ValueError("unsupported version %r" % data["version"])
+
+        for name, (count, seconds) in data["timings"].items():
+            timings[name] = (int(count), float(seconds))
+    except (ValueError, KeyError, TypeError, EnvironmentError) as e:
+        print("Cannot load action timings '%s': %s" % (file_name, e))
+        return {}
+
+    return timings
+
+def save_action_timings(file_name, timings):
+    """ Adds @timings (see ActionContext.timings) to ones accumulated in
+@file_name by previous runs.
+    """
+
+    total = load_action_timings(file_name)
+
+    for name, (count, seconds) in timings.items():
+        prev_count, prev_seconds = total.get(name, (0, 0.))
+        total[name] = (prev_count + count, prev_seconds + seconds)
+
+    f = open(file_name + ".tmp", "w")
+    json.dump(dict(
+            version = ACTION_TIMINGS_FILE_VERSION,
+            timings = total
+        ),
+        f,
+        indent = 0,
+        sort_keys = True
+    )
+    f.close()
+
+    if isfile(file_name):
+        unlink(file_name)
+    rename(file_name + ".tmp", file_name)
+
+def estimate_actions(actions, timings):
+    """ Predicts the cost of performing @actions by mean durations of action
+types in @timings (see load_action_timings).
+
+Returns a list of (name, count, seconds) tuples sorted by count in descending
+order and total seconds. `seconds` is None for a type without timings. Such
+actions are not counted in the total. Note that actions queued in course of
+conflict handling cannot be predicted.
+    """
+
+    counts = {}
+    for a in actions:
+        name = type(a).__name__
+        counts[name] = counts.get(name, 0) + 1
+
+    rows = []
+    total = 0.
+
+    for name, count in sorted(counts.items(), key = lambda i : (-i[1], i[0])):
+        try:
+            measured, seconds = timings[name]
+        except KeyError:
+            measured = 0
+
+        if measured:
+            seconds = count * seconds / measured
+            total += seconds
+        else:
+            seconds = None
+
+        rows.append((name, count, seconds))
+
+    return rows, total
+
 def orphan(n):
     return "__orphan__%d" % n
 
@@ -114,38 +492,106 @@ def plan_heads(c, dst_repo_path):
                 name = h.name
             )
 
-def get_actual_parents(orig_parent, sha2commit):
+def get_actual_parents(orig_parent, sha2commit, metadata, memo = None):
     """ A parent of a merge commit could be skipped. But a replacement have to
 be provided. This function looks it up. As a merge commit could be skipped too,
 one parent could be replaced with several parents.
+
+Commits are given by SHA1. @metadata maps SHA1 to CommitMetadata (it provides
+original parents order).
+
+memo:
+    A dict mapping SHA1 of skipped commits to their replacements. Every
+    skipped commit met during the lookup is resolved and put there. So, next
+    lookups through same chain of skipped commits take one step. Entries stay
+    valid while `skipped` flags of resolved commits are not changed. It is
+    true for `plan` because it only asks about already processed commits.
     """
 
-    if not sha2commit[orig_parent.hexsha].skipped:
+    if not sha2commit[orig_parent].skipped:
         return [orig_parent]
 
-    ret = []
-    # Parent order is reversed to preserve main stream (zero index) commit
-    # priority in course of depth-first graph traversal.
-    stack = list(reversed(orig_parent.parents))
+    if memo is None:
+        memo = {}
+
+    try:
+        return list(memo[orig_parent])
+    except KeyError:
+        pass
+
+    # Replacements of a skipped commit are replacements of its parents in
+    # original order. Hence, parents are resolved before the commit.
+    stack = [orig_parent]
     while stack:
-        p = stack.pop()
+        sha = stack[-1]
+        if sha in memo:
+            stack.pop()
+            continue
 
-        if sha2commit[p.hexsha].skipped:
-            stack.extend(reversed(p.parents))
-        else:
-            ret.append(p)
+        parents = metadata[sha].parents
+
+        pending = [
+            p for p in parents if sha2commit[p].skipped and p not in memo
+        ]
+        if pending:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+
+        ret = []
+        for p in parents:
+            if sha2commit[p].skipped:
+                ret.extend(memo[p])
+            else:
+                ret.append(p)
+        memo[sha] = ret
 
-    return ret
+    return list(memo[orig_parent])
 
 CLONED_REPO_NAME = "__cloned__"
 
-def plan(repo, sha2commit, dstRepoPath,
-    main_stream_bits = 0,
+def plan(repo, sha2commit, dstRepoPath, ctx = None, **kw):
+    """ Queues actions cloning @repo to @dstRepoPath to the action context
+@ctx. By default, it's the current context of calling thread. See _plan for
+other arguments.
+    """
+
+    if ctx is None or ctx is get_context():
+        return _plan(repo, sha2commit, dstRepoPath, **kw)
+
+    prev_ctx = switch_context(ctx)
+    try:
+        return _plan(repo, sha2commit, dstRepoPath, **kw)
+    finally:
+        switch_context(prev_ctx)
+
+def _plan(repo, sha2commit, dstRepoPath,
+    main_stream_head = None,
     breaks = None,
     skips = None,
-    insertions = None
+    insertions = None,
+    subtrees = None,
+    tips = None,
+    reorder = False
 ):
     """
+reorder:
+    Copy commits in an order minimizing checkouts (see order_commits) rather
+    than in `num` order.
+
+tips:
+    RefSnapshot of @repo (see get_ref_tips) the graph was built for. It is
+    read if not given.
+
+subtrees:
+    Result of detect_subtrees. Merges which are not in it are checked by
+    is_subtree during planning.
+
+main_stream_head:
+    SHA1 of a commit of the main stream. Commits having no common roots with
+    it are used as is.
+
 insertions:
     List of commits to insert. Each insertion is described by a tuple of
     an existing commit SHA1 and inserted commit content:
@@ -170,6 +616,13 @@ insertions:
     breaks = set() if breaks is None else set(breaks)
     skips = set() if skips is None else set(skips)
 
+    if main_stream_head is None:
+        main_stream_commits = None
+    else:
+        main_stream_commits = commits_sharing_roots(sha2commit,
+            main_stream_head
+        )
+
     # Group insertions by SHA1 for fastest search. Order of insertions for one
     # SHA1 must be preserved.
     insertion_table = {}
@@ -179,7 +632,11 @@ insertions:
 
     srcRepoPath = repo.working_dir
 
-    queue = sorted(sha2commit.values(), key = lambda c : c.num)
+    if isinstance(sha2commit, CompactGraph):
+        # it is already sorted
+        queue = sha2commit.by_num()
+    else:
+        queue = sorted(sha2commit.values(), key = lambda c : c.num)
 
     RemoveDirectory(path = dstRepoPath)
     ProvideDirectory(path = dstRepoPath)
@@ -195,6 +652,36 @@ insertions:
         tags = True
     )
 
+    # All commit fields needed are read at once.
+    metadata = read_commit_metadata(srcRepoPath,
+        [
+            c.sha for c in queue
+                if main_stream_commits is None or c.sha in main_stream_commits
+        ],
+        git_command = get_context().git_command
+    )
+
+    if reorder:
+        first_parents = {}
+        for c in queue:
+            m = metadata.get(c.sha, None)
+            if m is None:
+                parents = [ p.sha for p in c.parents ]
+            else:
+                parents = m.parents
+            first_parents[c.sha] = parents[0] if parents else None
+
+        checkouts = count_checkouts(queue, first_parents)
+        queue = order_commits(queue, first_parents)
+        reordered = count_checkouts(queue, first_parents)
+
+        print("Commit order: %d checkouts instead of %d (%d avoided)" % (
+            reordered, checkouts, checkouts - reordered
+        ))
+
+    # See get_actual_parents.
+    replacements = {}
+
     iqueue = iter(queue)
 
     orphan_counter = 0
@@ -205,13 +692,14 @@ insertions:
         c.processed = True
         c_sha = c.sha # attribute getting optimization
 
-        if main_stream_bits and not (c.roots & main_stream_bits):
+        if main_stream_commits is not None \
+        and c_sha not in main_stream_commits:
             # this commit will be used as is
             c.cloned_sha = c_sha
             # TODO: heads and tags of such commits
             continue
 
-        m = repo.commit(c_sha)
+        m = metadata[c_sha]
 
         if prev_c is not None:
             if not c.parents:
@@ -223,12 +711,14 @@ insertions:
                 at_least_one_in_trunk = False
             else:
                 # get real parents order
-                main_stream = m.parents[0]
-                main_stream_sha = main_stream.hexsha
+                main_stream_sha = m.parents[0]
                 if main_stream_sha != prev_c.sha:
                     # main stream parent of the commit could be skipped...
-                    aps = get_actual_parents(main_stream, sha2commit)
-                    actual_main_stream_parent_sha = aps[0].hexsha
+                    aps = get_actual_parents(main_stream_sha, sha2commit,
+                        metadata,
+                        memo = replacements
+                    )
+                    actual_main_stream_parent_sha = aps[0]
 
                     if actual_main_stream_parent_sha != main_stream_sha:
                         print("Main stream parent %s of %s is not available. "
@@ -266,19 +756,20 @@ insertions:
             # Handle merge commit parent skipping.
             extra_parents = []
             for p in m.parents[1:]:
-                aps = get_actual_parents(p, sha2commit)
+                aps = get_actual_parents(p, sha2commit, metadata,
+                    memo = replacements
+                )
 
                 if aps:
                     if aps[0] != p:
                         print("Parent %s of %s is skipped and will be "
                             "substituted with %s" % (
-                                p.hexsha, c_sha,
-                                ", ".join(pp.hexsha for pp in aps)
+                                p, c_sha, ", ".join(aps)
                             )
                         )
                 else:
                     print("Parent %s of %s is skipped and cannot be "
-                        "replaced" % (p.hexsha, c_sha)
+                        "replaced" % (p, c_sha)
                     )
 
                 extra_parents.extend(aps)
@@ -311,17 +802,24 @@ insertions:
             at_least_one_in_trunk = True
 
             if len(c.parents) > 1:
-                subtree_prefix = None if len(c.parents) != 2 else is_subtree(m)
+                if len(c.parents) != 2:
+                    subtree_prefix = None
+                elif subtrees is not None and c_sha in subtrees:
+                    subtree_prefix = subtrees[c_sha]
+                else:
+                    subtree_prefix = find_subtree_prefix(repo.git, c_sha,
+                        m.parents[1]
+                    )
 
                 SetAuthor(
-                    author_name = m.author.name,
-                    author_email = m.author.email,
+                    author_name = m.author_name,
+                    author_email = m.author_email,
                     authored_date = m.authored_date,
                     author_tz_offset = m.author_tz_offset
                 )
                 SetCommitter(
-                    committer_name = m.committer.name,
-                    committer_email = m.committer.email,
+                    committer_name = m.committer_name,
+                    committer_email = m.committer_email,
                     committed_date = m.committed_date,
                     committer_tz_offset = m.committer_tz_offset
                 )
@@ -332,16 +830,14 @@ insertions:
                         commit_sha = c_sha,
                         message = m.message,
                         # original parents order is significant
-                        extra_parents = [
-                            p.hexsha for p in extra_parents
-                        ]
+                        extra_parents = extra_parents
                     )
                 else:
                     SubtreeMerge(
                         path = dstRepoPath,
                         commit_sha = c_sha,
                         message = m.message,
-                        parent_sha = extra_parents[0].hexsha,
+                        parent_sha = extra_parents[0],
                         prefix = subtree_prefix
                     )
 
@@ -351,8 +847,8 @@ insertions:
             else:
                 # Note that author is set by cherry-pick
                 SetCommitter(
-                    committer_name = m.committer.name,
-                    committer_email = m.committer.email,
+                    committer_name = m.committer_name,
+                    committer_email = m.committer_email,
                     committed_date = m.committed_date,
                     committer_tz_offset = m.committer_tz_offset
                 )
@@ -398,8 +894,8 @@ insertions:
 
                 # Update committer name, e-mail and date after user actions.
                 SetCommitter(
-                    committer_name = m.committer.name,
-                    committer_email = m.committer.email,
+                    committer_name = m.committer_name,
+                    committer_email = m.committer_email,
                     committed_date = m.committed_date,
                     committer_tz_offset = m.committer_tz_offset
                 )
@@ -421,38 +917,27 @@ insertions:
     for o in range(0, orphan_counter):
         DeleteHead(path = dstRepoPath, name = orphan(o))
 
-    # propagate `used` flag
-    for c in queue:
-        if c.skipped:
-            continue
-        if not c.used:
-            continue
+    propagate_used(sha2commit, queue)
 
-        stack = list(c.parents)
-        while stack:
-            # a - ancestor
-            a = stack.pop()
-            if a.skipped:
-                continue # `skipped` commit do not propagate `used` flag
-            if a.used:
-                continue # `used` flag was already propagated
-            a.used = True
-            stack.append(reversed(a.parents))
+    if tips is None:
+        tips = get_ref_tips(srcRepoPath,
+            git_command = get_context().git_command
+        )
 
     # delete tags of non-cloned commits
-    for tag in repo.references:
-        if not tag.path.startswith("refs/tags/"):
-            continue
-
+    for name, sha in tips.iter_prefix("refs/tags/"):
         # Note that, no commit descriptors could be created for a trunk.
-        c = sha2commit.get(tag.commit.hexsha, None)
+        c = sha2commit.get(sha, None)
         if c is None or not c.used:
-            DeleteTag(path = dstRepoPath, name = tag.name)
-
-    CheckoutCloned(
-        path = dstRepoPath,
-        commit_sha = repo.head.commit.hexsha
-    )
+            DeleteTag(path = dstRepoPath, name = name)
+
+    head_sha = repo.head.commit.hexsha
+    # HEAD can be out of a part of the history, see plan_shards.
+    if sha2commit.get(head_sha, None) is not None:
+        CheckoutCloned(
+            path = dstRepoPath,
+            commit_sha = head_sha
+        )
     RemoveRemote(path = dstRepoPath, name = CLONED_REPO_NAME)
     CollectGarbage(path = dstRepoPath)
 
@@ -482,3 +967,221 @@ def load_context(file_name):
 
     # no saved context found among loaded objects
     raise RuntimeError("No context found in file '%s'" % file_name)
+
+def plan_shards(repo, sha2commit, dstRepoPath, shards_path, state_file_name,
+    jobs = None,
+    refs = None,
+    breaks = None,
+    skips = None,
+    insertions = None,
+    subtrees = None,
+    tips = None,
+    reorder = False,
+    ctx = None
+):
+    """ Splits the history into parts having no common roots (see `root`
+attribute of commit descriptors) and plans cloning of each part (a shard) to
+its own repository in a sub-directory of @shards_path. Shard contexts are saved
+to @state_file_name files there. Actions queued to @ctx (the current context by
+default) clone the shards by @jobs processes (see CloneShards) and fetch their
+references into @dstRepoPath.
+
+Returns False without planning if there is only one part.
+
+refs:
+    References the graph was built for (see co_build_git_graph).
+
+See _plan for other arguments.
+    """
+
+    if ctx is None:
+        ctx = get_context()
+
+    components = {}
+    for c in sha2commit.values():
+        components.setdefault(c.root, {})[c.sha] = c
+
+    if len(components) < 2:
+        return False
+
+    if tips is None:
+        tips = get_ref_tips(repo.working_dir, git_command = ctx.git_command)
+
+    selected = select_ref_tips(tips,
+        skip_remotes = True,
+        skip_stashes = True,
+        refs = refs
+    )
+
+    # Breaks, skips and insertions are given to shards of their commits.
+    # Unknown ones are given to the first shard to get usual errors.
+    first = next(iter(components))
+
+    def shard_of(sha):
+        c = sha2commit.get(sha, None)
+        return first if c is None else c.root
+
+    shard_breaks = {}
+    for sha in (breaks or []):
+        shard_breaks.setdefault(shard_of(sha), []).append(sha)
+
+    shard_skips = {}
+    for sha in (skips or []):
+        shard_skips.setdefault(shard_of(sha), []).append(sha)
+
+    shard_insertions = {}
+    for insertion in (insertions or []):
+        shard_insertions.setdefault(shard_of(insertion[0]), []).append(
+            insertion
+        )
+
+    head_sha = repo.head.commit.hexsha
+
+    shards = []
+    fetches = []
+
+    for i, (root, graph) in enumerate(components.items()):
+        shard_path = join(shards_path, str(i))
+        shard_repo_path = join(shard_path, "repo")
+        state_file = join(shard_path, state_file_name)
+        makedirs(shard_path)
+
+        print("Planning shard %d of %d commits in '%s'" % (
+            i, len(graph), shard_path
+        ))
+
+        shard_ctx = ctx.fork()
+        shard_ctx.log = LOG_STANDARD
+        shard_ctx._sha2commit = graph
+        shard_ctx._origin2cloned = {}
+
+        plan(repo, graph, shard_repo_path,
+            ctx = shard_ctx,
+            breaks = shard_breaks.get(root, None),
+            skips = shard_skips.get(root, None),
+            insertions = shard_insertions.get(root, None),
+            subtrees = subtrees,
+            tips = tips,
+            reorder = reorder
+        )
+
+        save_context(shard_ctx, state_file)
+
+        # references created in the shard
+        shard_refs = OrderedDict()
+        for a in shard_ctx.actions:
+            if isinstance(a, CreateHead):
+                shard_refs["refs/heads/" + a.name] = True
+            elif isinstance(a, CreateTag):
+                shard_refs["refs/tags/" + a.name] = True
+            elif isinstance(a, DeleteHead):
+                shard_refs.pop("refs/heads/" + a.name, None)
+            elif isinstance(a, DeleteTag):
+                shard_refs.pop("refs/tags/" + a.name, None)
+
+        shards.append((state_file,
+            [ path for path, sha in selected.items() if sha in graph ]
+        ))
+        fetches.append((shard_repo_path, list(shard_refs), head_sha in graph))
+
+    CloneShards(shards = shards, jobs = jobs, ctx = ctx)
+
+    RemoveDirectory(path = dstRepoPath, ctx = ctx)
+    ProvideDirectory(path = dstRepoPath, ctx = ctx)
+    InitRepo(path = dstRepoPath, ctx = ctx)
+
+    for shard_repo_path, shard_refs, head in fetches:
+        FetchShard(
+            path = dstRepoPath,
+            address = shard_repo_path,
+            refs = shard_refs,
+            head = head,
+            ctx = ctx
+        )
+
+    CollectGarbage(path = dstRepoPath, ctx = ctx)
+    RemoveDirectory(path = shards_path, ctx = ctx)
+
+    return True
+
+def clone_shard(task):
+    """ Continues cloning of a shard in a worker process of CloneShards.
+Returns (state file name, finished, timings).
+    """
+
+    state_file, refs = task
+    journal_file = state_file + ".journal"
+
+    try:
+        ctx = load_context(state_file)
+        ctx.replay(read_journal(journal_file))
+
+        # graph of the shard
+        GICCommitDesc.build_git_graph_rev_list(Repo(ctx.src_repo_path),
+            ctx._sha2commit,
+            skip_remotes = True,
+            skip_stashes = True,
+            refs = refs,
+            git_command = ctx.git_command
+        )
+        ctx.restore_cloned()
+
+        ctx.open_journal(state_file, journal_file)
+        ctx.do()
+
+        if ctx.finished:
+            unlink(state_file)
+        else:
+            save_context(ctx, state_file)
+        ctx.close_journal()
+    except:
+        print("Failed on shard '%s'" % state_file)
+        print_exc(file = sys.stdout)
+        return state_file, False, {}
+
+    return state_file, ctx.finished, ctx.timings
+
+class CloneShards(Action):
+    """ Clones shards planned by plan_shards by `jobs` processes (CPU count
+by default). Each shard has its own state file. A shard is finished when the
+file is removed. If some shards are interrupted (e.g. by conflicts), this
+action interrupts its context and is repeated by next launch.
+    """
+
+    __slots__ = ["shards", "jobs"]
+
+    def __call__(self):
+        ctx = self._ctx
+
+        tasks = [
+            (state_file, refs) for state_file, refs in self.shards
+                if isfile(state_file)
+        ]
+
+        pool = Pool(min(self.jobs or cpu_count(), len(tasks)) or 1)
+        try:
+            results = pool.map(clone_shard, tasks, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        unfinished = []
+        for state_file, finished, timings in results:
+            if not finished:
+                unfinished.append(join(dirname(state_file), "repo"))
+
+            for name, (n, seconds) in timings.items():
+                timing = ctx._timings.setdefault(name, [0, 0.])
+                timing[0] += n
+                timing[1] += seconds
+
+        if unfinished:
+            Interrupt(
+                reason = "Cloning of %d shard(s) is interrupted. Their "
+                    "repositories:\n    %s\nLaunch the tool again after "
+                    "changes." % (
+                        len(unfinished), "\n    ".join(unfinished)
+                    ),
+                ctx = ctx
+            )
+            CloneShards(shards = self.shards, jobs = self.jobs, ctx = ctx)
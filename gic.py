@@ -9,6 +9,7 @@ from actions import (
     LOG_STANDARD,
     GitContext,
     switch_context,
+    save_context,
     RemoveDirectory
 )
 from os.path import (
@@ -19,8 +20,12 @@ from os.path import (
 )
 from common import (
     launch,
+    get_ref_tips,
+    open_commit_graph,
+    GraphBuildProgress,
     composite_type,
-    pythonize
+    pythonize,
+    read_journal
 )
 from traceback import (
     print_exc,
@@ -30,7 +35,6 @@ import sys
 from os import (
     mkdir,
     rmdir,
-    rename,
     unlink,
     getcwd,
     chdir
@@ -39,7 +43,13 @@ from shutil import rmtree
 from itertools import count
 from core import (
     GICCommitDesc,
+    GICCompactGraph,
+    detect_subtrees,
+    load_action_timings,
+    save_action_timings,
+    estimate_actions,
     plan,
+    plan_shards,
     load_context
 )
 
@@ -229,6 +239,56 @@ def arg_type_git(string):
     return string
 
 STATE_FILE_NAME = ".gic-state.py"
+# Actions performed since the state file was saved (see
+# ActionContext.open_journal).
+JOURNAL_FILE_NAME = ".gic-state.journal"
+# Snapshot of the source repository graph reused by next launches.
+GRAPH_FILE_NAME = ".gic-graph"
+
+SUBTREES_FILE_NAME = ".gic-subtrees"
+
+# Repositories and state files of shards, see `--shard-jobs`.
+SHARDS_DIR_NAME = ".gic-shards"
+
+# Durations of actions performed by all launches, see `print_estimation`.
+TIMINGS_FILE_NAME = ".gic-timings"
+
+def expected_commits(repo):
+    """ Returns number of commits in the commit-graph file of @repo or None.
+It is only an estimation for progress reporting.
+    """
+
+    try:
+        graph = open_commit_graph(repo.git_dir)
+    except Exception:
+        return None
+
+    if graph is None:
+        return None
+
+    ret = len(graph)
+    graph.close()
+    return ret
+
+def print_estimation(actions, timings):
+    rows, total = estimate_actions(actions, timings)
+
+    print("%-24s %10s %12s" % ("Action", "Count", "Seconds"))
+    for name, count, seconds in rows:
+        print("%-24s %10d %12s" % (name, count,
+            "?" if seconds is None else ("%.2f" % seconds)
+        ))
+
+    print("Total actions: %d" % len(actions))
+
+    unknown = [ name for name, _, seconds in rows if seconds is None ]
+    if unknown:
+        print("No timings for: " + ", ".join(unknown))
+
+    hours, rest = divmod(int(total), 3600)
+    print("Estimated time: %d:%02d:%02d (without conflicts resolution and "
+        "break points)" % (hours, rest // 60, rest % 60)
+    )
 
 def main():
     print("Git Interactive Cloner")
@@ -324,6 +384,84 @@ original commit."""
 be interrupted on either a conflicts or a break point. All changes is taken
 from that patch."""
     )
+    ap.add_argument("--merge-tree",
+        action = "store_true",
+        help = """Create copies of commits by `git merge-tree --write-tree`
+and `git commit-tree` (git 2.38 is required, 2.40 for changed bases of
+cherry-picked commits). The working tree of the destination is only updated
+for conflicts and interruptions."""
+    )
+    ap.add_argument("--fast-import",
+        action = "store_true",
+        help = """Stream stretches of cherry-picked commits, whose trees are
+not changed, to one `git fast-import` process. Break points, conflicts and
+other actions are handled one by one."""
+    )
+    ap.add_argument("--branch-jobs",
+        type = int,
+        metavar = "N",
+        help = """Clone independent branches by N threads in linked working
+trees of the destination (git 2.17 is required). A branch is started when the
+commits it starts from and merges are cloned. Branches with break points and
+conflicts are cloned in the working tree of the destination."""
+    )
+    ap.add_argument("--reorder",
+        action = "store_true",
+        help = """Copy commits in a topological order keeping branches
+contiguous instead of the order commits were numbered in. It reduces the number of
+working tree checkouts. The number of avoided checkouts is printed."""
+    )
+    ap.add_argument("--shard-jobs",
+        type = int,
+        metavar = "N",
+        help = """Clone parts of the history having no common roots (e.g.
+unrelated trunks) by N processes (0 means CPU count) in temporary
+repositories in %s directory of the working directory. Then their
+references are fetched into the destination. Each part has its own state file
+there. If a part is interrupted, its repository should be fixed and the tool
+launched again.""" % SHARDS_DIR_NAME
+    )
+    ap.add_argument("--compact-journal",
+        type = int,
+        default = 10000,
+        metavar = "N",
+        help = """Performed actions are recorded in %s file. So, progress is
+not lost if the process is killed. Each N records, the state is saved to %s
+file and the journal is truncated (default: %%(default)s).""" % (
+            JOURNAL_FILE_NAME, STATE_FILE_NAME
+        )
+    )
+    ap.add_argument("--walk-graph",
+        action = "store_true",
+        help = """Build the graph of the source repository walking commit
+objects with GitPython instead of reading `git rev-list` output. It is much
+slower and is only kept as a fallback."""
+    )
+    ap.add_argument("--commit-graph",
+        action = "store_true",
+        help = """Read parents of commits from the commit-graph file of the
+source repository (see `git commit-graph write`) instead of `git rev-list`
+output. Commits which are not covered by the file are walked with GitPython.
+The graph is not saved between launches in this mode."""
+    )
+    ap.add_argument("--graph-stats",
+        metavar = "FILE",
+        help = """Write a summary of the graph building (counters and timings)
+to FILE in JSON format."""
+    )
+    ap.add_argument("--subtree-jobs",
+        type = int,
+        metavar = "N",
+        help = """Number of processes detecting subtree merges before planning
+(CPU count by default). Results are kept in %s file of the working directory
+and reused by next launches.""" % SUBTREES_FILE_NAME
+    )
+    ap.add_argument("--compact-graph",
+        action = "store_true",
+        help = """Keep the graph of the source repository in typed arrays
+instead of Python objects. It saves a lot of memory on huge repositories.
+The graph is not saved between launches in this mode."""
+    )
 
     args = ap.parse_args()
 
@@ -331,6 +469,9 @@ from that patch."""
     if isfile(STATE_FILE_NAME):
         try:
             ctx = load_context(STATE_FILE_NAME)
+            replayed = ctx.replay(read_journal(JOURNAL_FILE_NAME))
+            if replayed:
+                print("%d journaled records were replayed" % replayed)
         except:
             print("Incorrect state file")
             print_exc(file = sys.stdout)
@@ -380,22 +521,16 @@ from that patch."""
                 exit(1)
 
             # create all branches in temporal copy
-            tmp_repo = Repo(cloned_source)
+            tmp_tips = get_ref_tips(cloned_source, git_command = git_cmd)
 
             chdir(cloned_source)
 
-            for ref in list(tmp_repo.references):
-                if not ref.path.startswith("refs/remotes/origin/"):
-                    continue
-
-                # cut out prefix "origin/"
-                branch = ref.name[7:]
-
+            for branch, _ in tmp_tips.iter_prefix("refs/remotes/origin/"):
                 if branch == "HEAD" or branch == "master":
                     continue
 
                 try:
-                    launch([git_cmd, "branch", branch, ref.name],
+                    launch([git_cmd, "branch", branch, "origin/" + branch],
                         epfx = "Cannot create tracking branch '%s' in temporal"
                         " copy of origin repository" % branch
                     )
@@ -423,6 +558,8 @@ from that patch."""
             git_command = git_cmd,
             cache_path = args.cache_path,
             from_cache = args.from_cache,
+            merge_tree = args.merge_tree,
+            fast_import = args.fast_import,
             log = log
         )
 
@@ -433,62 +570,188 @@ from that patch."""
     print("Building graph of repository: " + srcRepoPath)
 
     repo = Repo(srcRepoPath)
+    # One snapshot of references is shared by the graph building and planning.
+    tips = get_ref_tips(srcRepoPath, git_command = ctx.git_command)
     sha2commit = ctx._sha2commit
-    GICCommitDesc.build_git_graph(repo, sha2commit,
-        skip_remotes = True,
-        skip_stashes = True,
-        refs = args.refs
+    stats = {}
+    if args.compact_graph:
+        sha2commit = GICCompactGraph()
+        ctx._sha2commit = sha2commit
+        co = sha2commit.co_build_git_graph(repo,
+            skip_remotes = True,
+            skip_stashes = True,
+            refs = args.refs,
+            git_command = ctx.git_command,
+            stats = stats,
+            tips = tips
+        )
+    elif args.commit_graph:
+        co = GICCommitDesc.co_build_git_graph_commit_graph(repo, sha2commit,
+            skip_remotes = True,
+            skip_stashes = True,
+            refs = args.refs,
+            git_command = ctx.git_command,
+            stats = stats,
+            tips = tips
+        )
+    elif args.walk_graph:
+        co = GICCommitDesc.co_build_git_graph(repo, sha2commit,
+            skip_remotes = True,
+            skip_stashes = True,
+            refs = args.refs,
+            git_command = ctx.git_command,
+            stats = stats,
+            tips = tips
+        )
+    else:
+        co = GICCommitDesc.co_build_git_graph_cached(repo, sha2commit,
+            join(init_cwd, GRAPH_FILE_NAME),
+            skip_remotes = True,
+            skip_stashes = True,
+            refs = args.refs,
+            git_command = ctx.git_command,
+            stats = stats,
+            tips = tips
+        )
+
+    progress = GraphBuildProgress(sha2commit, stats,
+        expected = expected_commits(repo)
     )
+    progress.run(co)
+
+    if stats.get("loaded", 0):
+        print("The graph was loaded from " + GRAPH_FILE_NAME)
+
+    if args.graph_stats is not None:
+        progress.write_summary(args.graph_stats)
 
     print("Total commits: %d" % len(sha2commit))
 
-    if ctx.current_action < 0:
+    # A snapshot written before the first action was performed has pending
+    # actions already. Old versions did not mark it as started.
+    if ctx.current_action < 0 and not ctx.actions:
         destination = args.destination
         if destination is None:
             print("No destination specified. Dry run.")
-            return
-
-        dstRepoPath = destination
-
-        ms = args.main_stream
-        if ms:
-            ms_bits = sha2commit[ms].roots
+            # Planned actions are only counted. So, the directory is never
+            # created.
+            dstRepoPath = join(init_cwd, ".gic-dry-run")
         else:
-            ms_bits = 0
+            dstRepoPath = destination
+
+            print("The repository will be cloned to: " + dstRepoPath)
+
+        # A dry run does not analyze merges. Ones not analyzed by previous
+        # launches are estimated as usual merges.
+        subtrees_stats = {}
+        subtrees = detect_subtrees(repo, sha2commit,
+            file_name = join(init_cwd, SUBTREES_FILE_NAME),
+            workers = args.subtree_jobs,
+            stats = subtrees_stats,
+            detect = destination is not None
+        )
+        print("Subtree merge detection: %d loaded from %s, %d analyzed" % (
+            subtrees_stats["loaded"], SUBTREES_FILE_NAME,
+            subtrees_stats["detected"]
+        ))
 
-        print("The repository will be cloned to: " + dstRepoPath)
+        if destination is None:
+            # The plan is only counted. So, it's queued to a throw-away
+            # context.
+            estimation = ctx.fork()
+            estimation._origin2cloned = {}
+
+            plan(repo, sha2commit, dstRepoPath,
+                ctx = estimation,
+                breaks = args.breaks,
+                skips = args.skips,
+                main_stream_head = args.main_stream or None,
+                insertions = args.insertions,
+                subtrees = subtrees,
+                tips = tips,
+                reorder = args.reorder
+            )
+
+            print_estimation(estimation.actions,
+                load_action_timings(join(init_cwd, TIMINGS_FILE_NAME))
+            )
+            return
 
         # Planing
-        plan(repo, sha2commit, dstRepoPath,
-            breaks = args.breaks,
-            skips = args.skips,
-            main_stream_bits = ms_bits,
-            insertions = args.insertions
-        )
+        sharded = False
+        if args.shard_jobs is not None:
+            if args.compact_graph or args.main_stream:
+                print("Sharding is not supported with --compact-graph and "
+                    "--main-stream"
+                )
+            else:
+                shards_path = join(init_cwd, SHARDS_DIR_NAME)
+                if isdir(shards_path):
+                    rmtree(shards_path)
+
+                sharded = plan_shards(repo, sha2commit, dstRepoPath,
+                    shards_path, STATE_FILE_NAME,
+                    jobs = args.shard_jobs or None,
+                    refs = args.refs,
+                    breaks = args.breaks,
+                    skips = args.skips,
+                    insertions = args.insertions,
+                    subtrees = subtrees,
+                    tips = tips,
+                    reorder = args.reorder,
+                    ctx = ctx
+                )
+                if not sharded:
+                    print("The history has one part only. No sharding.")
+
+        if not sharded:
+            plan(repo, sha2commit, dstRepoPath,
+                ctx = ctx,
+                breaks = args.breaks,
+                skips = args.skips,
+                main_stream_head = args.main_stream or None,
+                insertions = args.insertions,
+                subtrees = subtrees,
+                tips = tips,
+                reorder = args.reorder
+            )
 
         # remove temporal clone of the source repository
         if cloned_source:
-            RemoveDirectory(path = cloned_source)
+            RemoveDirectory(path = cloned_source, ctx = ctx)
     else:
         print("The context was loaded. Continuing...")
 
         ctx.restore_cloned()
 
-    ctx.do()
+    ctx.open_journal(STATE_FILE_NAME, JOURNAL_FILE_NAME,
+        compact_every = args.compact_journal
+    )
+
+    if args.branch_jobs:
+        ctx.do_parallel(args.branch_jobs)
+    else:
+        ctx.do()
 
     # save results
     if getcwd() != init_cwd:
         chdir(init_cwd)
 
+    save_action_timings(TIMINGS_FILE_NAME, ctx.timings)
+
+    print("Process launches saved: %d" % (
+        ctx.saved_spawns
+    ))
+
     if ctx.finished:
         if isfile(STATE_FILE_NAME):
             unlink(STATE_FILE_NAME)
+        if isfile(GRAPH_FILE_NAME):
+            unlink(GRAPH_FILE_NAME)
     else:
-        pythonize(ctx, STATE_FILE_NAME + ".tmp")
+        save_context(ctx, STATE_FILE_NAME)
 
-        if isfile(STATE_FILE_NAME):
-            unlink(STATE_FILE_NAME)
-        rename(STATE_FILE_NAME + ".tmp", STATE_FILE_NAME)
+    ctx.close_journal()
 
     rs = args.result_state
     if rs: